@@ -0,0 +1,273 @@
+# Standard library imports
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+log = logging.getLogger(__name__)
+
+YOUTUBE_HOSTS = ('youtube.com', 'www.youtube.com', 'm.youtube.com', 'music.youtube.com')
+
+# Files in the cache directory that the index doesn't know are deleted once they are this many seconds old,
+# which leaves downloads in progress and just finished alone
+ORPHAN_AGE = 3600
+
+
+def make_key(extractor_key, video_id):
+    """
+    Build the cache key of a video. It doubles as the file name stem on disk.
+
+    :param extractor_key: The yt-dlp extractor key, e.g. "Youtube"
+    :param video_id: The ID of the video on that site
+    """
+    return f"{extractor_key}-{video_id}"
+
+
+def key_from_url(url):
+    """
+    Work out the cache key of a YouTube URL without asking yt-dlp.
+
+    :param url: The URL passed to ?play
+    :return: The cache key, or None if the URL isn't a single YouTube video
+    """
+    try:
+        parsed = urlparse(url if '://' in url else f'https://{url}')
+    except ValueError:
+        return None
+
+    host = (parsed.hostname or '').lower()
+    video_id = None
+    if host in ('youtu.be', 'www.youtu.be'):
+        video_id = parsed.path.lstrip('/').split('/')[0]
+    elif host in YOUTUBE_HOSTS:
+        if parsed.path == '/watch':
+            video_id = parse_qs(parsed.query).get('v', [None])[0]
+        elif parsed.path.startswith(('/shorts/', '/live/', '/embed/')):
+            video_id = parsed.path.split('/')[2]
+
+    if not video_id:
+        return None
+    return make_key('Youtube', video_id)
+
+
+class AudioCache:
+    """
+    A size-capped, on-disk cache of downloaded audio keyed by extractor and video ID.
+
+    The index is kept in ``index.json`` inside the cache directory, so cached
+    tracks survive restarts. Entries are ordered from least to most recently
+    used.
+
+    Lookups and additions only touch the index in memory. Deleting files and
+    saving the index are left to the janitor started with ``run``: once the
+    total size goes over ``max_bytes``, it evicts the least recently used
+    tracks that no queue refers to, a batch at a time and with the file IO
+    in an executor, so the event loop never waits on the disk. It also
+    deletes stray files the index doesn't know, such as abandoned partial
+    downloads.
+    """
+
+    def __init__(self, directory, max_bytes):
+        """
+        :param directory: The directory the audio files are stored in
+        :param max_bytes: The total size the cached files may take up
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._index_path = self.directory / 'index.json'
+        self._entries = OrderedDict()
+        self._size = 0
+        self._dirty = False
+        self._over_budget_warned = False
+        # The number of tracks evicted since startup
+        self.evictions = 0
+        self._load()
+
+    @property
+    def size(self):
+        """
+        The total size of the cached files in bytes.
+        """
+        return self._size
+
+    def get(self, key):
+        """
+        Look up a cached track and mark it as recently used.
+
+        :param key: The cache key of the track
+        :return: The cache entry with its absolute ``filename``, or None on a miss
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        filename = self.directory / entry['filename']
+        if not filename.is_file():
+            # The file was removed behind our back
+            self._drop(key)
+            self._dirty = True
+            return None
+
+        entry['last_used'] = time.time()
+        self._entries.move_to_end(key)
+        self._dirty = True
+        return dict(entry, filename=str(filename))
+
+    def put(self, key, filename, **metadata):
+        """
+        Add a downloaded file to the cache. The janitor makes room for it later.
+
+        :param key: The cache key of the track
+        :param filename: The path of the file, which must live in the cache directory
+        :param metadata: Extra fields stored with the entry, e.g. the title
+        :return: The cache entry with its absolute ``filename``
+        """
+        filename = Path(filename)
+        if key in self._entries:
+            self._drop(key)
+
+        entry = dict(metadata, filename=filename.name, size=filename.stat().st_size, last_used=time.time())
+        self._entries[key] = entry
+        self._size += entry['size']
+        self._dirty = True
+        return dict(entry, filename=str(filename))
+
+    def update(self, key, **metadata):
+        """
+        Change the metadata of a cached track, e.g. once it has been analysed.
+
+        :param key: The cache key of the track
+        :param metadata: The fields to set
+        :return: Whether the track was still cached
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return False
+        entry.update(metadata)
+        self._dirty = True
+        return True
+
+    async def run(self, in_use, *, interval=30, batch=20):
+        """
+        Keep the cache within its budget and save the index every ``interval`` seconds, until cancelled.
+
+        :param in_use: A function returning the set of cache keys referred to by queued tracks, which are never evicted
+        :param interval: The number of seconds between passes
+        :param batch: The most files deleted in one go before the event loop gets a turn again
+        """
+        await self.remove_orphans(batch=batch)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.collect(in_use, batch=batch)
+            except OSError as e:
+                log.error("Error cleaning up the audio cache: %s", e)
+
+    async def collect(self, in_use, *, batch=20):
+        """
+        Evict unreferenced tracks until the cache fits its budget, then save the index if it changed.
+
+        :param in_use: See ``run``
+        :param batch: See ``run``
+        """
+        loop = asyncio.get_running_loop()
+        while self._size > self.max_bytes:
+            # Taken again for every batch, since the queues change while the files are deleted
+            filenames = self._take_victims(in_use(), batch)
+            if not filenames:
+                if not self._over_budget_warned:
+                    self._over_budget_warned = True
+                    log.warning("The audio cache is %d MB over its budget, but every track in it is queued",
+                                (self._size - self.max_bytes) // 1024 ** 2)
+                break
+            self._dirty = True
+            await loop.run_in_executor(None, self._delete, filenames)
+        else:
+            self._over_budget_warned = False
+        if self._dirty:
+            self._dirty = False
+            entries = {key: dict(entry) for key, entry in self._entries.items()}
+            await loop.run_in_executor(None, self._write_index, entries)
+
+    async def remove_orphans(self, *, batch=20):
+        """
+        Delete files in the cache directory that the index doesn't know, once they are ``ORPHAN_AGE`` seconds old.
+
+        :param batch: See ``run``
+        """
+        loop = asyncio.get_running_loop()
+        files = await loop.run_in_executor(None, self._list_files)
+        known = {entry['filename'] for entry in self._entries.values()}
+        known.update((self._index_path.name, self._index_path.with_suffix('.tmp').name))
+        cutoff = time.time() - ORPHAN_AGE
+        orphans = [self.directory / name for name, modified in files if name not in known and modified < cutoff]
+        if orphans:
+            log.info("Deleting %d stray files from the audio cache", len(orphans))
+        for start in range(0, len(orphans), batch):
+            await loop.run_in_executor(None, self._delete, orphans[start:start + batch])
+
+    def flush(self):
+        """
+        Save the index right away, e.g. on shutdown.
+        """
+        if self._dirty:
+            self._dirty = False
+            self._write_index(self._entries)
+
+    def _take_victims(self, pinned, count):
+        filenames = []
+        for key in list(self._entries):
+            if self._size <= self.max_bytes or len(filenames) >= count:
+                break
+            if key not in pinned:
+                log.debug("Evicting %s from the audio cache", key)
+                filenames.append(self.directory / self._entries[key]['filename'])
+                self._drop(key)
+                self.evictions += 1
+        return filenames
+
+    def _list_files(self):
+        with os.scandir(self.directory) as entries:
+            return [(entry.name, entry.stat().st_mtime) for entry in entries if entry.is_file()]
+
+    @staticmethod
+    def _delete(filenames):
+        for filename in filenames:
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                # e.g. still open on Windows; it is picked up as a stray file later
+                log.warning("Unable to delete %s from the audio cache: %s", filename, e)
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self._size -= entry['size']
+
+    def _load(self):
+        try:
+            with open(self._index_path, 'r') as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            log.error("Error loading the audio cache index, starting empty: %s", e)
+            return
+
+        for key, entry in sorted(entries.items(), key=lambda item: item[1].get('last_used', 0)):
+            if (self.directory / entry['filename']).is_file():
+                self._entries[key] = entry
+                self._size += entry['size']
+
+    def _write_index(self, entries):
+        # Write to a temporary file first so a crash can't leave a torn index behind
+        temp_path = self._index_path.with_suffix('.tmp')
+        with open(temp_path, 'w') as f:
+            json.dump(entries, f)
+        os.replace(temp_path, self._index_path)
@@ -0,0 +1,245 @@
+"""
+Drive many simulated guilds through ?play and ?skip with yt-dlp, Spotify and Discord faked out.
+
+Run from the repository root:
+
+    python benchmarks/bot_throughput.py --guilds 200 --plays 5 --skips 2
+
+No network access, Discord token or FFmpeg is needed. Each guild joins a
+fake voice channel, queues ``--plays`` songs (a mix of YouTube links,
+searches and Spotify tracks), skips ``--skips`` times once audio has
+started and then plays the rest of its queue, with every "song" lasting
+``--track-seconds``. Lookups and downloads sleep for the given latencies
+and copy a local file into a temporary audio cache, so the numbers cover
+the bot's own overhead: dispatch, the download pool, caching, the player
+tasks and the message outbox.
+
+Reported are command throughput, time to first audio per guild, memory
+per guild and how often the event loop was blocked, which catches
+blocking calls slipping into the command handlers. Afterwards every guild
+sits idle for ``--idle-gap`` seconds and plays one more song, and the run
+fails if that wait was counted as a track transition. ``--json`` prints the results as JSON, e.g. for comparing runs
+in CI.
+"""
+# Standard library imports
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+# Local Files
+import fakes
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def make_queries(guild_index, plays, shared_ratio, spotify_ratio, rng):
+    """
+    Pick the ?play arguments of one guild.
+
+    Shared queries are drawn from a small pool used by every guild, so they
+    exercise the caches and in-flight deduplication the way popular songs do.
+    """
+    queries = []
+    for play_index in range(plays):
+        name = f"popular {rng.randrange(20)}" if rng.random() < shared_ratio else f"guild {guild_index} song {play_index}"
+        kind = rng.random()
+        if kind < spotify_ratio:
+            queries.append(f"https://open.spotify.com/track/{fakes.video_id(name)}")
+        elif kind < spotify_ratio + (1 - spotify_ratio) / 2:
+            queries.append(fakes.video_url(name))
+        else:
+            queries.append(name)
+    return queries
+
+
+async def run_guild(main, guild, queries, skips, skip_interval, command_times):
+    ctx = fakes.FakeContext(guild)
+    requested_at = time.perf_counter()
+    for query in queries:
+        start = time.perf_counter()
+        await main.play.callback(ctx, query)
+        command_times.append(time.perf_counter() - start)
+    queued_at = time.perf_counter()
+
+    player = main.get_player(guild.id)
+    while not guild.voice_client or not guild.voice_client.started:
+        await asyncio.sleep(0.001)
+    first_audio = guild.voice_client.started[0] - requested_at
+
+    for _ in range(skips):
+        await asyncio.sleep(skip_interval)
+        start = time.perf_counter()
+        await main.skip.callback(ctx)
+        command_times.append(time.perf_counter() - start)
+
+    if player.task is not None:
+        await player.task
+    return first_audio, queued_at
+
+
+async def requeue_after_idle(main, guild):
+    """
+    Play one more song in a guild whose queue has run dry, and wait for it to finish.
+    """
+    ctx = fakes.FakeContext(guild)
+    await main.play.callback(ctx, f"guild {guild.id} song after idle")
+    player = main.get_player(guild.id)
+    if player.task is not None:
+        await player.task
+
+
+async def run(main, args, workdir):
+    from audio_cache import AudioCache
+    from download_pool import DownloadPool
+    from state_store import StateStore
+
+    cache_dir = workdir / 'cache'
+    main.download_options['outtmpl'] = str(cache_dir / '%(extractor_key)s-%(id)s.%(ext)s')
+    main.audio_cache = AudioCache(cache_dir, 1024 ** 3)
+    main.state_store = StateStore(str(workdir / 'state.sqlite3'))
+    main.download_pool = DownloadPool(main.music_processor, min_workers=args.workers, max_workers=args.workers,
+                                      mode='thread')
+    main.download_pool.start()
+
+    loop = asyncio.get_running_loop()
+    main.bot.loop = loop
+    background = [loop.create_task(main.download_pool.deliver_results()),
+                  loop.create_task(main.state_store.run(main.snapshot_guild))]
+    main.loop_watchdog.start(loop)
+
+    rng = random.Random(args.seed)
+    guilds = [fakes.FakeGuild(index + 1, args.track_seconds) for index in range(args.guilds)]
+    queries = [make_queries(index, args.plays, args.shared_ratio, args.spotify_ratio, rng) for index in range(args.guilds)]
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if args.trace_memory:
+        tracemalloc.start()
+    command_times = []
+    start = time.perf_counter()
+    outcomes = await asyncio.gather(*(
+        run_guild(main, guild, guild_queries, args.skips, args.skip_interval, command_times)
+        for guild, guild_queries in zip(guilds, queries)))
+    elapsed = time.perf_counter() - start
+    first_audio = [first for first, _ in outcomes]
+    # Throughput of the ?play burst, from the first command until every guild's songs were queued
+    play_elapsed = max(queued_at for _, queued_at in outcomes) - start
+    traced_peak = tracemalloc.get_traced_memory()[1] if args.trace_memory else None
+    tracemalloc.stop()
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # The first song after an idle spell follows nothing, so it must not add a transition
+    transitions = main.transition_seconds.labels()
+    transitions_before = transitions.count
+    await asyncio.sleep(args.idle_gap)
+    await asyncio.gather(*(requeue_after_idle(main, guild) for guild in guilds))
+    idle_transitions = transitions.count - transitions_before
+
+    main.loop_watchdog.stop()
+    for task in background:
+        task.cancel()
+    main.download_pool.close()
+    main.state_store.flush(main.snapshot_guild)
+
+    played = sum(len(guild.voice_client.started) for guild in guilds if guild.voice_client)
+    results = {
+        'guilds': args.guilds,
+        'commands': len(command_times),
+        'elapsed_seconds': elapsed,
+        'plays_per_second': args.guilds * args.plays / play_elapsed,
+        'command_latency_ms_p50': percentile(command_times, 0.5) * 1000,
+        'command_latency_ms_p99': percentile(command_times, 0.99) * 1000,
+        'tracks_started': played,
+        'tracks_per_second': played / elapsed,
+        'time_to_first_audio_ms_p50': percentile(first_audio, 0.5) * 1000,
+        'time_to_first_audio_ms_p95': percentile(first_audio, 0.95) * 1000,
+        'time_to_first_audio_ms_max': max(first_audio) * 1000,
+        # ru_maxrss is in kilobytes on Linux
+        'rss_growth_kb_per_guild': (rss_after - rss_before) / args.guilds,
+        'messages_sent': sum(guild.text_channel.sent for guild in guilds),
+        'loop_stalls': main.loop_watchdog.stall_count,
+        'loop_lag_ms_max': main.loop_watchdog.max_lag * 1000,
+        'idle_gaps_counted_as_transitions': idle_transitions,
+    }
+    if traced_peak is not None:
+        results['traced_peak_kb_per_guild'] = traced_peak / 1024 / args.guilds
+    return results
+
+
+def report(results):
+    print(f"{results['guilds']} guilds, {results['commands']} commands in {results['elapsed_seconds']:.2f} s")
+    print(f"?play          {results['plays_per_second']:10.1f} /s")
+    print(f"command time   p50 {results['command_latency_ms_p50']:8.2f} ms   p99 {results['command_latency_ms_p99']:8.2f} ms")
+    print(f"tracks started {results['tracks_per_second']:10.1f} /s   total {results['tracks_started']}")
+    print(f"first audio    p50 {results['time_to_first_audio_ms_p50']:8.2f} ms   "
+          f"p95 {results['time_to_first_audio_ms_p95']:8.2f} ms   max {results['time_to_first_audio_ms_max']:8.2f} ms")
+    print(f"memory         {results['rss_growth_kb_per_guild']:10.1f} KB RSS growth per guild", end='')
+    if 'traced_peak_kb_per_guild' in results:
+        print(f"   {results['traced_peak_kb_per_guild']:.1f} KB traced peak per guild", end='')
+    print()
+    print(f"messages sent  {results['messages_sent']}")
+    print(f"loop stalls    {results['loop_stalls']:10d}   max lag {results['loop_lag_ms_max']:8.2f} ms")
+    print(f"idle gaps counted as transitions {results['idle_gaps_counted_as_transitions']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--guilds', type=int, default=100, help='Number of simulated guilds')
+    parser.add_argument('--plays', type=int, default=5, help='?play commands per guild')
+    parser.add_argument('--skips', type=int, default=2, help='?skip commands per guild, once audio has started')
+    parser.add_argument('--skip-interval', type=float, default=0.05, help='Seconds between skips')
+    parser.add_argument('--track-seconds', type=float, default=0.1, help='Simulated length of every song')
+    parser.add_argument('--search-latency', type=float, default=0.02, help='Seconds each yt-dlp/Spotify lookup takes')
+    parser.add_argument('--download-latency', type=float, default=0.05, help='Seconds each download takes')
+    parser.add_argument('--idle-gap', type=float, default=0.2,
+                        help='Seconds every guild sits idle before playing one more song')
+    parser.add_argument('--workers', type=int, default=4, help='Number of download workers')
+    parser.add_argument('--shared-ratio', type=float, default=0.3, help='Share of plays drawn from songs every guild plays')
+    parser.add_argument('--spotify-ratio', type=float, default=0.2, help='Share of plays that are Spotify links')
+    parser.add_argument('--audio-file', help='Local audio file served as every download (default: 64 KB of noise)')
+    parser.add_argument('--trace-memory', action='store_true', help='Also measure Python allocations (slows the run down)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for picking the queries')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        audio_file = args.audio_file
+        if audio_file is None:
+            audio_file = workdir / 'audio.webm'
+            audio_file.write_bytes(os.urandom(64 * 1024))
+        fakes.install(audio_file, search_latency=args.search_latency, download_latency=args.download_latency)
+
+        # main reads settings.json from the working directory
+        os.chdir(ROOT)
+        import main as bot_main
+        bot_main.configure_logging()
+        # Transition budget warnings are expected once the simulated workers are saturated
+        bot_main.logging.getLogger().setLevel('ERROR')
+
+        results = asyncio.run(run(bot_main, args, workdir))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
+    if results['idle_gaps_counted_as_transitions']:
+        sys.exit("The wait before a song played after an idle spell was counted as a track transition")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+"""
+Local stand-ins for YouTube, Spotify and Discord, for running the bot without a network.
+
+``install()`` has to be called before ``main`` is imported, since ``main``
+builds its Spotify client at import time.
+"""
+# Standard library imports
+import asyncio
+import datetime
+import hashlib
+import itertools
+import shutil
+import time
+from types import SimpleNamespace
+
+# Third-party imports
+import discord
+import spotipy
+import spotipy.oauth2
+import yt_dlp
+
+# Local Files
+import loudness
+
+# Simulated latencies in seconds, set by install()
+latency = SimpleNamespace(search=0.0, download=0.0)
+
+# The local file every "download" is copied from, set by install()
+audio_file = None
+
+_message_ids = itertools.count(1)
+
+
+def video_id(text):
+    """
+    Derive a stable 11-character video ID from a search query or track name.
+
+    :param text: The text to derive the ID from
+    """
+    return hashlib.sha1(text.encode()).hexdigest()[:11]
+
+
+def video_url(text):
+    return f"https://www.youtube.com/watch?v={video_id(text)}"
+
+
+class FakeYoutubeDL:
+    """
+    Answers ``extract_info`` for any URL or ``ytsearch:`` query, and "downloads" by copying a local file.
+    """
+
+    def __init__(self, params=None):
+        self.params = params or {}
+
+    def extract_info(self, url, download=True):
+        time.sleep(latency.search)
+        if url.startswith('ytsearch:'):
+            info = self._info(video_id(url[len('ytsearch:'):]))
+            result = {'_type': 'playlist', 'entries': [info]}
+        else:
+            result = info = self._info(url.rsplit('=', 1)[-1].rsplit('/', 1)[-1])
+        if download:
+            self.process_ie_result(info, download=True)
+        return result
+
+    def prepare_filename(self, info):
+        return self.params.get('outtmpl', '%(extractor_key)s-%(id)s.%(ext)s') % info
+
+    def process_ie_result(self, info, download=True):
+        time.sleep(latency.download)
+        shutil.copyfile(audio_file, self.prepare_filename(info))
+        return info
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def _info(video):
+        return {
+            'id': video,
+            'extractor_key': 'Youtube',
+            'title': f"Video {video}",
+            'ext': 'webm',
+            'acodec': 'opus',
+            'duration': 180,
+            'url': f"https://media.invalid/{video}.webm",
+            'webpage_url': f"https://www.youtube.com/watch?v={video}",
+        }
+
+
+class FakeSpotify:
+    """
+    Makes up track metadata for any Spotify ID.
+    """
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    @staticmethod
+    def _track(track_id):
+        return {'id': track_id, 'name': f"Song {track_id}", 'artists': [{'name': 'Artist'}], 'duration_ms': 180000}
+
+    def tracks(self, track_ids):
+        time.sleep(latency.search)
+        return {'tracks': [self._track(track_id) for track_id in track_ids]}
+
+
+class FakeAudioSource:
+    """
+    Takes the place of ``discord.FFmpegOpusAudio`` without starting FFmpeg.
+    """
+
+    def __init__(self, filename, **kwargs):
+        self.filename = filename
+        self.kwargs = kwargs
+
+    def cleanup(self):
+        pass
+
+
+class FakeVoiceClient:
+    """
+    "Plays" a source for a fixed time, then cleans it up and calls ``after`` like discord.py does.
+    """
+
+    def __init__(self, guild, channel, track_seconds):
+        self.guild = guild
+        self.channel = channel
+        self.track_seconds = track_seconds
+        self.average_latency = 0.0
+        self.started = []  # time.perf_counter() of every play() call
+        self._source = None
+        self._after = None
+        self._handle = None
+        self._paused = False
+
+    def play(self, source, *, after=None):
+        self.started.append(time.perf_counter())
+        self._source = source
+        self._after = after
+        self._handle = asyncio.get_running_loop().call_later(self.track_seconds, self._finish)
+
+    def _finish(self):
+        source, after, self._source, self._after, self._handle = self._source, self._after, None, None, None
+        if source is not None:
+            source.cleanup()
+        if after is not None:
+            after(None)
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._finish()
+
+    def is_playing(self):
+        return self._handle is not None and not self._paused
+
+    def is_paused(self):
+        return self._handle is not None and self._paused
+
+    def pause(self):
+        self._paused = True
+
+    def resume(self):
+        self._paused = False
+
+    def is_connected(self):
+        return True
+
+    async def disconnect(self, *, force=False):
+        self.stop()
+        self.guild.voice_client = None
+
+
+class FakeMessage:
+    def __init__(self, channel, embed):
+        self.id = next(_message_ids)
+        self.channel = channel
+        self.embed = embed
+
+    async def edit(self, *, embed=None, view=None):
+        self.embed = embed
+        return self
+
+
+class FakeTextChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.last_message_id = None
+        self.sent = 0
+
+    async def send(self, content=None, *, embed=None, view=None):
+        message = FakeMessage(self, embed)
+        self.last_message_id = message.id
+        self.sent += 1
+        return message
+
+    def typing(self):
+        return _NoTyping()
+
+
+class _NoTyping:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class FakeVoiceChannel:
+    def __init__(self, guild, channel_id, track_seconds):
+        self.guild = guild
+        self.id = channel_id
+        self.members = []
+        self.track_seconds = track_seconds
+
+    async def connect(self, **kwargs):
+        self.guild.voice_client = FakeVoiceClient(self.guild, self, self.track_seconds)
+        return self.guild.voice_client
+
+
+class FakeGuild:
+    def __init__(self, guild_id, track_seconds):
+        self.id = guild_id
+        self.voice_client = None
+        self.text_channel = FakeTextChannel(guild_id * 10 + 1)
+        self.voice_channel = FakeVoiceChannel(self, guild_id * 10 + 2, track_seconds)
+
+    def get_channel(self, channel_id):
+        return {self.text_channel.id: self.text_channel, self.voice_channel.id: self.voice_channel}.get(channel_id)
+
+
+class FakeContext:
+    """
+    The parts of ``commands.Context`` the bot's commands use.
+    """
+
+    def __init__(self, guild):
+        self.guild = guild
+        self.channel = guild.text_channel
+        self.author = SimpleNamespace(name='listener', voice=SimpleNamespace(channel=guild.voice_channel))
+        self.message = SimpleNamespace(author=self.author, guild=guild,
+                                       created_at=datetime.datetime.now(datetime.timezone.utc))
+
+    async def send(self, content=None, *, embed=None, view=None):
+        return await self.channel.send(content, embed=embed, view=view)
+
+    def typing(self):
+        return self.channel.typing()
+
+
+def fake_measure_loudness(executable, filename, timeout=120):
+    """
+    Stand-in for ``loudness.measure_loudness`` that reports every file at the default target.
+
+    :param executable: The path of the FFmpeg binary, ignored
+    :param filename: The audio file, ignored
+    :param timeout: Ignored
+    """
+    return {'input_i': -16.0, 'input_tp': -1.5}
+
+
+def install(audio_path, *, search_latency=0.0, download_latency=0.0):
+    """
+    Swap the fakes in for yt-dlp, spotipy and FFmpeg.
+
+    :param audio_path: The local file every download is copied from
+    :param search_latency: The number of seconds each lookup takes
+    :param download_latency: The number of seconds each download takes
+    """
+    global audio_file
+    audio_file = audio_path
+    latency.search = search_latency
+    latency.download = download_latency
+    yt_dlp.YoutubeDL = FakeYoutubeDL
+    spotipy.Spotify = FakeSpotify
+    spotipy.oauth2.SpotifyClientCredentials = lambda **kwargs: None
+    discord.FFmpegOpusAudio = FakeAudioSource
+    # main imports it by name, so this has to be in place before main is imported
+    loudness.measure_loudness = fake_measure_loudness
@@ -0,0 +1,78 @@
+"""
+Measure the per-request cost of setting up yt-dlp, with and without the pooled instances.
+
+Run from the repository root:
+
+    python benchmarks/ytdl_setup.py --requests 50
+
+No network access is needed: each simulated request only does the setup
+work a real one does before its first HTTP call, i.e. creating the
+YoutubeDL instance, looking up the YouTube extractor and opening the
+HTTP request director.
+"""
+# Standard library imports
+import argparse
+import statistics
+import sys
+import time
+from pathlib import Path
+
+# Third-party imports
+import yt_dlp as youtube_dl
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# Local Files
+from ytdl_pool import close_all, get_ytdl
+
+OPTIONS = {
+    'format': 'bestaudio[acodec=opus]/bestaudio/best',
+    'outtmpl': '%(extractor_key)s-%(id)s.%(ext)s',
+    'noplaylist': True,
+    'quiet': True,
+}
+
+
+def prepare(ydl):
+    ydl.get_info_extractor('Youtube')
+    ydl._request_director
+
+
+def fresh_request():
+    ydl = youtube_dl.YoutubeDL(OPTIONS)
+    prepare(ydl)
+    ydl.close()
+
+
+def pooled_request():
+    prepare(get_ytdl('benchmark', OPTIONS))
+
+
+def measure(request, count):
+    timings = []
+    for _ in range(count):
+        start = time.perf_counter()
+        request()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def report(name, timings):
+    print(f"{name:<8} mean {statistics.mean(timings):8.2f} ms   "
+          f"median {statistics.median(timings):8.2f} ms   "
+          f"max {max(timings):8.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=50, help='Number of simulated requests per mode')
+    args = parser.parse_args()
+
+    report('fresh', measure(fresh_request, args.requests))
+    # The first pooled request pays for creating the instance, just like a fresh one
+    report('pooled', measure(pooled_request, args.requests))
+    close_all()
+
+
+if __name__ == '__main__':
+    main()
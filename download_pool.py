@@ -0,0 +1,333 @@
+# Standard library imports
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+
+log = logging.getLogger(__name__)
+
+
+class WorkerLostError(Exception):
+    """
+    Raised to ``fetch`` callers when the worker holding their task died or the task timed out,
+    and the pool has no ``on_lost`` function to make up a result.
+    """
+
+
+class _Worker:
+    __slots__ = ('process', 'tasks', 'results', 'task', 'started', 'retiring')
+
+    def __init__(self, process, tasks, results):
+        self.process = process
+        # The worker's own task queue, so the pool knows which task each worker holds
+        self.tasks = tasks
+        # And its own result queue, so a worker dying halfway through a write can't block the others' results
+        self.results = results
+        # The ``(request_id, payload)`` it is working on, if any
+        self.task = None
+        # When it was handed that task
+        self.started = None
+        self.retiring = False
+
+
+class _Lost:
+    # Stands in for the result of a task whose worker died or ran out of time
+    __slots__ = ('payload',)
+
+    def __init__(self, payload):
+        self.payload = payload
+
+
+class DownloadPool:
+    """
+    A pool of download workers fed from per-guild backlogs.
+
+    Tasks are handed to the workers round-robin across guilds, so a guild that
+    queues ten songs can't starve another guild's single request. The pool
+    spawns extra workers while there is a backlog and retires them again once
+    they have been sitting idle for ``idle_timeout`` seconds.
+
+    Every worker runs ``target(task_queue, result_queue)`` with queues of
+    its own. Tasks arrive as ``(request_id, payload)`` tuples, and the
+    worker must answer each one with exactly one ``(request_id, result)``
+    tuple on ``result_queue``. It exits when it receives ``None``. If a
+    worker dies while holding a task, or is still working on it ``timeout``
+    seconds after picking it up, its callers get ``on_lost(payload)`` as the
+    result instead of waiting forever.
+    """
+
+    def __init__(self, target, *, min_workers=1, max_workers=4, mode='process', idle_timeout=60, timeout=None,
+                 on_lost=None, context=None):
+        """
+        :param target: The worker loop function
+        :param min_workers: The number of workers kept alive while idle
+        :param max_workers: The upper bound on concurrent workers
+        :param mode: "process" or "thread"
+        :param idle_timeout: Seconds of idleness before a worker is retired
+        :param timeout: Seconds a worker may spend on a task before its callers give up on it,
+            or None to wait as long as it takes
+        :param on_lost: A function making up the result of a lost task from its payload;
+            without it ``fetch`` raises ``WorkerLostError``
+        :param context: The multiprocessing context worker processes are started with, by default the platform's
+        """
+        if mode == 'process':
+            context = context or multiprocessing.get_context()
+            self._worker_cls = context.Process
+            self._queue_cls = context.Queue
+        elif mode == 'thread':
+            self._worker_cls = threading.Thread
+            self._queue_cls = queue.Queue
+        else:
+            raise ValueError(f"Unknown download worker mode: {mode}")
+
+        self._target = target
+        self.min_workers = max(0, min_workers)
+        self.max_workers = max(1, max_workers, self.min_workers)
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._on_lost = on_lost
+
+        # Results are forwarded here once the pool has accounted for them
+        self.results = queue.Queue()
+
+        self._backlog = OrderedDict()  # guild_id -> deque of tasks
+        self._pending = 0
+        self._workers = []  # Including the retiring ones until they have exited
+        self._holders = {}  # request_id -> the _Worker holding it
+        self._last_activity = time.monotonic()
+        self._condition = threading.Condition()
+        self._running = False
+        self._threads = []
+        self._request_ids = itertools.count()
+        self._futures = {}  # request_id -> asyncio.Future
+        self._inflight = {}  # dedupe key -> asyncio.Future
+
+    @property
+    def size(self):
+        """
+        The number of workers currently accepting tasks.
+        """
+        return sum(1 for worker in self._workers if not worker.retiring)
+
+    def start(self):
+        """
+        Start the first workers and the dispatcher.
+        """
+        self._running = True
+        self._workers.extend(self._create_worker() for _ in range(self.min_workers))
+
+        thread = threading.Thread(target=self._dispatch_loop, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def submit(self, guild_id, task):
+        """
+        Add a task to the backlog of a guild.
+
+        :param guild_id: The guild the task is queued for
+        :param task: The item handed to the worker
+        """
+        with self._condition:
+            if guild_id not in self._backlog:
+                self._backlog[guild_id] = deque()
+            self._backlog[guild_id].append(task)
+            self._pending += 1
+            self._condition.notify()
+
+    async def fetch(self, guild_id, payload, key=None):
+        """
+        Queue a task for a guild and wait for its result.
+
+        Only the calling coroutine is woken up when the result arrives, so
+        concurrent requests never see each other's results. Calls made with
+        the same ``key`` while a task is still running share that task and
+        its result instead of queuing a new one.
+
+        :param guild_id: The guild the task is queued for
+        :param payload: The item handed to the worker
+        :param key: An optional key identifying identical tasks
+        :return: The result produced by the worker
+        """
+        future = self._inflight.get(key) if key is not None else None
+        if future is None or future.done():
+            request_id = next(self._request_ids)
+            future = asyncio.get_running_loop().create_future()
+            self._futures[request_id] = future
+            if key is not None:
+                self._inflight[key] = future
+                future.add_done_callback(lambda done: self._forget(key, done))
+            self.submit(guild_id, (request_id, payload))
+        # Shielded so a cancelled caller doesn't cancel the task for everyone else waiting on it
+        return await asyncio.shield(future)
+
+    async def deliver_results(self):
+        """
+        Resolve the futures of ``fetch`` callers as results come in.
+
+        This is the single hand-off point between the workers and the event
+        loop and is meant to run as one long-lived task.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            result = await loop.run_in_executor(None, self.results.get)
+            if result is None:
+                break
+            request_id, value = result
+            future = self._futures.pop(request_id, None)
+            if future is None or future.done():
+                continue
+            if isinstance(value, _Lost):
+                self._resolve_lost(future, value.payload)
+            else:
+                future.set_result(value)
+
+    def close(self):
+        """
+        Stop dispatching and tell every worker to shut down.
+        """
+        with self._condition:
+            self._running = False
+            for worker in self._workers:
+                worker.tasks.put(None)
+            self._condition.notify()
+        self.results.put(None)
+
+    def _forget(self, key, future):
+        # A newer task may have taken over the key since, which must stay shared
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+
+    def _resolve_lost(self, future, payload):
+        # Later calls with the same key start over rather than sharing the failure
+        for key in [key for key, pending in self._inflight.items() if pending is future]:
+            del self._inflight[key]
+        if self._on_lost is not None:
+            future.set_result(self._on_lost(payload))
+        else:
+            future.set_exception(WorkerLostError(f"Download task {payload!r} was lost"))
+
+    def _create_worker(self):
+        tasks, results = self._queue_cls(), self._queue_cls()
+        process = self._worker_cls(target=self._target, args=(tasks, results), daemon=True)
+        process.start()
+        worker = _Worker(process, tasks, results)
+        # Stops on its own once the worker has exited
+        threading.Thread(target=self._collect_loop, args=(worker,), daemon=True).start()
+        return worker
+
+    def _idle_workers(self):
+        return [worker for worker in self._workers if worker.task is None and not worker.retiring]
+
+    def _retire(self):
+        worker = self._idle_workers()[0]
+        worker.retiring = True
+        worker.tasks.put(None)
+
+    def _reap(self):
+        alive = []
+        for worker in self._workers:
+            if worker.process.is_alive():
+                alive.append(worker)
+                continue
+            if worker.retiring:
+                continue
+            log.warning("A download worker exited unexpectedly with code %s", getattr(worker.process, 'exitcode', None))
+            # It never reports back for the task it was holding, so fail that task for its callers
+            if worker.task is not None and self._holders.pop(worker.task[0], None) is not None:
+                self.results.put((worker.task[0], _Lost(worker.task[1])))
+        self._workers = alive
+
+    def _expire(self):
+        # Waiting in the backlog doesn't count, only the time since a worker picked the task up
+        if self.timeout is None:
+            return
+        now = time.monotonic()
+        for worker in self._workers:
+            if worker.task is None or now - worker.started < self.timeout:
+                continue
+            request_id, payload = worker.task
+            if self._holders.pop(request_id, None) is not None:
+                log.warning("Download task %r timed out after %s s", payload, self.timeout)
+                # The worker stays busy until it answers, and that answer is dropped
+                self.results.put((request_id, _Lost(payload)))
+
+    def _scale(self):
+        """
+        Retire an idle worker if there is one too many.
+
+        :return: The number of workers to start
+        """
+        idle = len(self._idle_workers())
+        if self._pending > idle and self.size < self.max_workers:
+            return min(self._pending - idle, self.max_workers - self.size)
+        if self.size < self.min_workers:
+            return self.min_workers - self.size
+        if not self._pending and idle > 0 and self.size > self.min_workers:
+            if time.monotonic() - self._last_activity >= self.idle_timeout:
+                self._retire()
+                self._last_activity = time.monotonic()
+        return 0
+
+    def _next_task(self):
+        guild_id, tasks = next(iter(self._backlog.items()))
+        task = tasks.popleft()
+        if tasks:
+            # Rotate the guild to the back so every guild gets a turn
+            self._backlog.move_to_end(guild_id)
+        else:
+            del self._backlog[guild_id]
+        self._pending -= 1
+        return task
+
+    def _dispatch_loop(self):
+        while True:
+            with self._condition:
+                if not self._running:
+                    break
+                self._reap()
+                self._expire()
+                spawn = self._scale()
+                for worker in self._idle_workers():
+                    if not self._pending:
+                        break
+                    worker.task = self._next_task()
+                    worker.started = time.monotonic()
+                    self._holders[worker.task[0]] = worker
+                    self._last_activity = time.monotonic()
+                    worker.tasks.put(worker.task)
+                if not spawn:
+                    self._condition.wait(timeout=1)
+                    continue
+
+            # Starting a process takes a while, and submit() on the event loop must not wait on the lock meanwhile
+            workers = [self._create_worker() for _ in range(spawn)]
+            with self._condition:
+                self._workers.extend(workers)
+                if not self._running:
+                    # close() ran while they were starting
+                    for worker in workers:
+                        worker.tasks.put(None)
+
+    def _collect_loop(self, worker):
+        while True:
+            try:
+                result = worker.results.get(timeout=1)
+            except queue.Empty:
+                if worker.process.is_alive():
+                    continue
+                # Anything it was still holding is failed by _reap
+                break
+            with self._condition:
+                late = self._holders.pop(result[0], None) is None
+                worker.task = None
+                self._last_activity = time.monotonic()
+                self._condition.notify()
+            if late:
+                # The task timed out or its worker was written off as dead, and it already failed for its callers
+                log.info("Dropping the late result of download task %s", result[0])
+                continue
+            self.results.put(result)
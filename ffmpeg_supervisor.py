@@ -0,0 +1,193 @@
+# Standard library imports
+import asyncio
+import functools
+import logging
+import os
+
+# Third-party imports
+import discord
+
+log = logging.getLogger(__name__)
+
+# Clock ticks per second, for the CPU times in /proc/<pid>/stat
+try:
+    CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+except (AttributeError, ValueError, OSError):
+    CLOCK_TICKS = 100
+
+
+def read_process_stats(pid):
+    """
+    Read the CPU time and memory use of a process from /proc.
+
+    :param pid: The ID of the process
+    :return: A dict with ``cpu_seconds``, ``rss_bytes`` and ``peak_rss_bytes``, or None if unavailable
+    """
+    try:
+        with open(f'/proc/{pid}/stat', 'rb') as f:
+            # The command name may contain spaces, so split after its closing parenthesis
+            fields = f.read().rsplit(b')', 1)[1].split()
+        with open(f'/proc/{pid}/status', 'rb') as f:
+            status = dict(line.split(b':', 1) for line in f.read().splitlines() if b':' in line)
+    except (OSError, IndexError, ValueError):
+        return None
+
+    def kilobytes(name):
+        value = status.get(name)
+        return int(value.split()[0]) * 1024 if value else 0
+
+    # utime and stime are the 14th and 15th fields of the whole line
+    return {
+        'cpu_seconds': (int(fields[11]) + int(fields[12])) / CLOCK_TICKS,
+        'rss_bytes': kilobytes(b'VmRSS'),
+        'peak_rss_bytes': kilobytes(b'VmHWM'),
+    }
+
+
+class SupervisedSource(discord.AudioSource):
+    """
+    An FFmpeg source that gives its slot back to the supervisor once it is cleaned up.
+    """
+
+    def __init__(self, supervisor, source, filename):
+        self.supervisor = supervisor
+        self.source = source
+        self.filename = filename
+        process = getattr(source, '_process', None)
+        self.pid = getattr(process, 'pid', None)
+        self._released = False
+
+    def read(self):
+        return self.source.read()
+
+    def is_opus(self):
+        return self.source.is_opus()
+
+    def cleanup(self):
+        # discord.py calls this from its audio thread, and again when the source is garbage collected
+        if self._released:
+            return
+        self._released = True
+        self.supervisor._finished(self)
+        self.source.cleanup()
+
+
+class FFmpegSupervisor:
+    """
+    Starts the FFmpeg processes used for playback and keeps their number in check.
+
+    At most ``max_processes`` decoders run at once across all guilds; past
+    that, new tracks wait up to ``slot_timeout`` seconds for one to finish.
+    Local files and remote streams get their own input options, so HTTP
+    reconnect flags are only passed for streams. A loudness gain is applied
+    in FFmpeg's filter chain, so no volume scaling happens in Python. CPU
+    time and memory of every process are read from /proc, both while it
+    runs and when it ends.
+    """
+
+    def __init__(self, executable, *, file_options, stream_options, max_processes=64, slot_timeout=15):
+        """
+        :param executable: The path of the FFmpeg binary
+        :param file_options: The ``before_options``/``options`` dict for local files
+        :param stream_options: The ``before_options``/``options`` dict for remote streams
+        :param max_processes: The most FFmpeg processes allowed to run at once
+        :param slot_timeout: The number of seconds to wait for a free slot before giving up
+        """
+        self.executable = executable
+        self.file_options = file_options
+        self.stream_options = stream_options
+        self.max_processes = max_processes
+        self.slot_timeout = slot_timeout
+        self.finished_cpu_seconds = 0.0
+        self._slots = asyncio.Semaphore(max_processes)
+        self._running = set()
+        self._waiting = 0
+        self._loop = None
+
+    @property
+    def running(self):
+        return len(self._running)
+
+    @property
+    def waiting(self):
+        return self._waiting
+
+    async def open(self, filename, codec, *, gain=None, offset=0, wait=True):
+        """
+        Start an FFmpeg process for a track.
+
+        :param filename: The local file or stream URL of the track
+        :param codec: The audio codec of the source, if known; Opus is passed through without transcoding
+        :param gain: The gain to apply in dB, if any; it needs the audio re-encoded, so Opus isn't passed through then
+        :param offset: The position in seconds to start from. FFmpeg seeks the input to it, which for a stream
+            is an HTTP range request rather than reading up to it
+        :param wait: Whether to wait for a free slot, rather than giving up right away when all are taken
+        :return: The source, or None if no slot became free in time
+        """
+        self._loop = asyncio.get_running_loop()
+        if not wait:
+            if self._slots.locked():
+                return None
+            await self._slots.acquire()
+        else:
+            self._waiting += 1
+            try:
+                await asyncio.wait_for(self._slots.acquire(), self.slot_timeout)
+            except asyncio.TimeoutError:
+                log.warning("No FFmpeg slot became free within %s s, %d processes running", self.slot_timeout, self.running)
+                return None
+            finally:
+                self._waiting -= 1
+
+        stream = filename.startswith(('http://', 'https://'))
+        if not stream:
+            filename = os.path.abspath(filename)
+        options = self.stream_options if stream else self.file_options
+        # Gains too small to hear aren't worth giving up the Opus passthrough for
+        if gain is not None and abs(gain) >= 0.5:
+            options = dict(options, options=f"{options.get('options', '')} -af volume={gain:.2f}dB".strip())
+            codec = None
+        if offset:
+            options = dict(options, before_options=f"-ss {offset:.3f} {options.get('before_options', '')}".strip())
+        log.debug("Starting FFmpeg for %s (%s, gain %s dB)", filename, codec, gain)
+        # Opus audio is remuxed into Ogg and sent to Discord as-is; anything else is encoded to Opus once
+        create = functools.partial(discord.FFmpegOpusAudio, filename, codec='copy' if codec == 'opus' else None,
+                                   executable=self.executable, **options)
+        try:
+            # Forking FFmpeg can take a while on a busy host, keep it off the event loop
+            source = SupervisedSource(self, await self._loop.run_in_executor(None, create), filename)
+        except BaseException:
+            self._slots.release()
+            raise
+        self._running.add(source)
+        return source
+
+    def stats(self):
+        """
+        Read the CPU time and memory use of every running FFmpeg process.
+
+        :return: A list of dicts with the ``pid`` and ``filename`` of each process along with its stats
+        """
+        results = []
+        for source in list(self._running):
+            stats = read_process_stats(source.pid) if source.pid else None
+            if stats is not None:
+                results.append(dict(stats, pid=source.pid, filename=source.filename))
+        return results
+
+    def _finished(self, source):
+        stats = read_process_stats(source.pid) if source.pid else None
+        if stats is not None:
+            self.finished_cpu_seconds += stats['cpu_seconds']
+            log.debug("FFmpeg %s for %s used %.2f s CPU, peak RSS %.1f MB", source.pid, source.filename,
+                      stats['cpu_seconds'], stats['peak_rss_bytes'] / 1024 ** 2)
+        try:
+            self._loop.call_soon_threadsafe(self._release, source)
+        except RuntimeError:
+            # The event loop is already closed
+            pass
+
+    def _release(self, source):
+        if source in self._running:
+            self._running.discard(source)
+            self._slots.release()
@@ -0,0 +1,442 @@
+# Standard library imports
+import asyncio
+import itertools
+import random
+import time
+from collections import deque
+
+# Local Files
+from audio_cache import key_from_url
+
+# How many played tracks are remembered for "?skip back"
+HISTORY_LENGTH = 50
+
+_track_ids = itertools.count()
+
+
+class Track:
+    """
+    An entry in a guild's music queue.
+
+    Tracks are queued as soon as they are requested and resolved in the
+    background; ``task`` is the resolve task once it has been started.
+    ``duration`` is in seconds, or None while it isn't known, and must be
+    changed through ``GuildPlayer.set_duration`` once the track is queued.
+    ``gain`` is the loudness correction in dB measured at download time.
+    ``start_at`` is the position in seconds the track starts from the next
+    time it is opened, e.g. after a seek or a restart.
+    ``place`` and ``order`` say where the track is in its guild's queue, so
+    a saved copy of a single track can be updated without the rest.
+    """
+    __slots__ = ('query', 'guild_id', 'title', 'filename', 'key', 'codec', 'spotify_id', 'task', 'duration', 'queued',
+                 'requested_at', 'gain', 'start_at', 'track_id', 'place', 'order')
+
+    def __init__(self, query, guild_id, title=None, spotify_id=None, duration=None):
+        self.track_id = next(_track_ids)
+        self.query = query
+        self.guild_id = guild_id
+        self.title = title or query
+        self.filename = None
+        self.key = key_from_url(query)
+        self.codec = None
+        self.spotify_id = spotify_id
+        self.task = None
+        self.duration = duration
+        # Whether the track is the current or an upcoming one of its guild, kept up to date by GuildPlayer
+        self.queued = False
+        # The time.perf_counter() value of the ?play that should start this track right away, if any
+        self.requested_at = None
+        self.gain = None
+        self.start_at = None
+        # "current", "upcoming", "history" or None, kept up to date by GuildPlayer, and the position within it.
+        # Orders only have to sort, so a track can move without renumbering the others.
+        self.place = None
+        self.order = 0
+
+
+class GuildPlayer:
+    """
+    The music queue and repeat settings of one guild.
+
+    The queue is split into the ``current`` track, the ``upcoming`` tracks
+    and the ``history`` of played ones, so moving forwards and backwards
+    only touches the ends of a deque. Removing or moving a track in the
+    middle of the queue is O(n). Methods must only be called from the event
+    loop thread; FFmpeg callbacks have to hand over to the loop before
+    touching the queue.
+
+    The total duration of the current and upcoming tracks is kept up to
+    date as tracks come and go, so showing it doesn't walk the queue.
+    Every change to the tracks or repeat settings calls
+    ``on_change(guild_id, tracks, replace)`` so the state can be saved:
+    ``tracks`` are the tracks whose place, order or details changed,
+    including ones that left the queue, and ``replace`` is True when every
+    track may have changed.
+
+    The playback position of the current track is worked out from when it
+    started and where, so it costs nothing while the track plays.
+    """
+    __slots__ = ('guild_id', 'current', 'upcoming', 'history', '_repeat_queue', '_repeat_song', 'skip_direction',
+                 'task', 'track_finished', 'ended_at', 'channel', 'total_duration', 'unknown_durations', 'on_change',
+                 'prepared', 'position_base', 'resumed_at')
+
+    def __init__(self, guild_id, on_change=None):
+        self.guild_id = guild_id
+        self.on_change = on_change
+        self.current = None
+        self.upcoming = deque()
+        self.history = deque(maxlen=HISTORY_LENGTH)
+        self._repeat_queue = False
+        self._repeat_song = False
+        # Set by "?skip" so the end of the current track moves in that direction
+        self.skip_direction = None
+        # The task playing through the queue, and the event it waits on while a track plays
+        self.task = None
+        self.track_finished = asyncio.Event()
+        self.ended_at = None
+        # The channel messages about playback go to
+        self.channel = None
+        # The summed duration of the queued tracks, and the number of queued tracks whose duration isn't known
+        self.total_duration = 0
+        self.unknown_durations = 0
+        # A ``(track, source)`` pair whose decoder was started ahead of time for the next track
+        self.prepared = None
+        # The position the current track had reached when it last started or was paused,
+        # and the time.perf_counter() value it last started or resumed at (None while paused)
+        self.position_base = 0.0
+        self.resumed_at = None
+
+    def __len__(self):
+        return len(self.upcoming) + (self.current is not None)
+
+    def __iter__(self):
+        """
+        Iterate over the current track followed by the upcoming ones.
+        """
+        if self.current is not None:
+            yield self.current
+        yield from self.upcoming
+
+    def __contains__(self, track):
+        return track.queued and track.guild_id == self.guild_id
+
+    @property
+    def position(self):
+        """
+        How far into the current track playback is, in seconds.
+        """
+        if self.resumed_at is None:
+            return self.position_base
+        return self.position_base + time.perf_counter() - self.resumed_at
+
+    @property
+    def repeat_queue(self):
+        return self._repeat_queue
+
+    @repeat_queue.setter
+    def repeat_queue(self, value):
+        self._repeat_queue = value
+        self._changed()
+
+    @property
+    def repeat_song(self):
+        return self._repeat_song
+
+    @repeat_song.setter
+    def repeat_song(self, value):
+        self._repeat_song = value
+        self._changed()
+
+    def load(self, current, upcoming, history):
+        """
+        Replace every track, e.g. with the ones saved before a restart.
+
+        :param current: The current track, or None
+        :param upcoming: The upcoming tracks, in order
+        :param history: The played tracks, oldest first
+        """
+        self.reset()
+        for order, track in enumerate(history):
+            self.history.append(self._place(track, 'history', order))
+        self.extend(upcoming)
+        if current is not None:
+            self._enter(current)
+            self._place(current, 'current')
+        self.current = current
+        self._changed(replace=True)
+
+    def add(self, track):
+        """
+        Add a track to the end of the queue.
+
+        :param track: The track to add
+        """
+        self._enter(track)
+        self._place(track, 'upcoming', self._back_order())
+        self.upcoming.append(track)
+        self._changed([track])
+
+    def extend(self, tracks):
+        """
+        Add several tracks to the end of the queue.
+
+        :param tracks: The tracks to add
+        """
+        for track in tracks:
+            self._enter(track)
+            self._place(track, 'upcoming', self._back_order())
+            self.upcoming.append(track)
+        self._changed(tracks)
+
+    def set_duration(self, track, duration):
+        """
+        Record the duration of a track once it is known.
+
+        :param track: The track, queued or not
+        :param duration: The duration in seconds, or None
+        """
+        if track.queued:
+            self._leave(track)
+            track.duration = duration
+            self._enter(track)
+        else:
+            track.duration = duration
+        self.update(track)
+
+    def update(self, track):
+        """
+        Note that the details of a track, e.g. its title, have changed.
+
+        :param track: The track, queued or not
+        """
+        if track.place is not None:
+            self._changed([track])
+
+    def advance(self, direction='next'):
+        """
+        Move on from the current track.
+
+        :param direction: "finished" when the track ended by itself, or "next"/"back" for a skip
+        :return: The new current track, or None if the queue has run out
+        """
+        if direction == 'finished' and self.repeat_song and self.current is not None:
+            return self.current
+
+        if direction == 'back':
+            if self.repeat_queue and self.upcoming:
+                # The previous track of a repeating queue is the last one
+                previous = self.upcoming.pop()
+            elif self.history:
+                previous = self.history.pop()
+                self._enter(previous)
+            else:
+                # Nothing to go back to, so restart the current track
+                return self.current
+            changed = [self._place(previous, 'current')]
+            if self.current is not None:
+                changed.append(self._place(self.current, 'upcoming', self._front_order()))
+                self.upcoming.appendleft(self.current)
+            self.current = previous
+            self._changed(changed)
+            return self.current
+
+        changed = []
+        if self.current is not None:
+            changed.append(self.current)
+            if self.repeat_queue:
+                self._place(self.current, 'upcoming', self._back_order())
+                self.upcoming.append(self.current)
+            else:
+                self._leave(self.current)
+                if len(self.history) == self.history.maxlen:
+                    # Appending pushes the oldest one out
+                    changed.append(self._place(self.history[0], None))
+                self._place(self.current, 'history', self.history[-1].order + 1 if self.history else 0)
+                self.history.append(self.current)
+        self.current = self.upcoming.popleft() if self.upcoming else None
+        if self.current is not None:
+            changed.append(self._place(self.current, 'current'))
+        self._changed(changed)
+        return self.current
+
+    def peek_next(self):
+        """
+        Get the track that ``advance('finished')`` would move to, without moving.
+
+        :return: The track, or None if the queue would run out
+        """
+        if self.repeat_song and self.current is not None:
+            return self.current
+        if self.upcoming:
+            return self.upcoming[0]
+        if self.repeat_queue:
+            return self.current
+        return None
+
+    def seek(self, position):
+        """
+        Make the current track start over from a position once its playback is stopped.
+
+        :param position: The position in seconds
+        """
+        self.current.start_at = position
+        self.skip_direction = 'seek'
+        self._changed()
+
+    def playback_started(self, position):
+        """
+        Note that the current track started playing.
+
+        :param position: The position in seconds it started from
+        """
+        self.position_base = position
+        self.resumed_at = time.perf_counter()
+
+    def playback_paused(self):
+        if self.resumed_at is not None:
+            self.position_base = self.position
+            self.resumed_at = None
+
+    def playback_resumed(self):
+        if self.resumed_at is None:
+            self.resumed_at = time.perf_counter()
+
+    def playback_stopped(self):
+        self.position_base = 0.0
+        self.resumed_at = None
+
+    def finish_track(self, ended_at):
+        """
+        Wake up the player task once the current track has stopped playing.
+
+        :param ended_at: The ``time.perf_counter()`` value at which the track stopped
+        """
+        self.ended_at = ended_at
+        self.track_finished.set()
+
+    def drop_current(self):
+        """
+        Remove the current track without keeping it in the history, e.g. because it couldn't be played.
+        """
+        changed = []
+        if self.current is not None:
+            self._leave(self.current)
+            changed.append(self._place(self.current, None))
+        self.current = None
+        self._changed(changed)
+
+    def remove(self, position):
+        """
+        Remove an upcoming track.
+
+        :param position: The 1-based position of the track among the upcoming ones
+        :return: The removed track
+        """
+        if not 1 <= position <= len(self.upcoming):
+            raise IndexError(f"There is no song at position {position}.")
+        track = self.upcoming[position - 1]
+        del self.upcoming[position - 1]
+        self._leave(track)
+        self._changed([self._place(track, None)])
+        return track
+
+    def move(self, source, destination):
+        """
+        Move an upcoming track to another position.
+
+        :param source: The 1-based position of the track to move
+        :param destination: The 1-based position to move it to
+        :return: The moved track
+        """
+        if not 1 <= destination <= len(self.upcoming):
+            raise IndexError(f"There is no position {destination} in the queue.")
+        track = self.remove(source)
+        self._enter(track)
+        self.upcoming.insert(destination - 1, track)
+        before = self.upcoming[destination - 2].order if destination > 1 else None
+        after = self.upcoming[destination].order if destination < len(self.upcoming) else None
+        if before is None and after is None:
+            order = 0
+        elif before is None:
+            order = after - 1
+        elif after is None:
+            order = before + 1
+        else:
+            order = (before + after) / 2
+        self._place(track, 'upcoming', order)
+        if order == before or order == after:
+            # Moved between the same two tracks so often that there is no order left in between
+            self._renumber()
+            self._changed(self.upcoming)
+        else:
+            self._changed([track])
+        return track
+
+    def shuffle(self):
+        """
+        Shuffle the upcoming tracks, leaving the current one alone.
+        """
+        tracks = list(self.upcoming)
+        random.shuffle(tracks)
+        self.upcoming = deque(tracks)
+        self._renumber()
+        self._changed(tracks)
+
+    def clear(self):
+        """
+        Remove the upcoming and played tracks, leaving the current one alone.
+        """
+        for track in self.upcoming:
+            track.queued = False
+            track.place = None
+        for track in self.history:
+            track.place = None
+        self.upcoming.clear()
+        self.history.clear()
+        self.total_duration = 0
+        self.unknown_durations = 0
+        if self.current is not None:
+            self._enter(self.current)
+        self._changed(replace=True)
+
+    def reset(self):
+        """
+        Remove every track, including the current one.
+        """
+        self.drop_current()
+        self.clear()
+        self.skip_direction = None
+
+    def _changed(self, tracks=(), replace=False):
+        if self.on_change is not None:
+            self.on_change(self.guild_id, tracks, replace)
+
+    @staticmethod
+    def _place(track, place, order=0):
+        track.place = place
+        track.order = order
+        return track
+
+    def _front_order(self):
+        return self.upcoming[0].order - 1 if self.upcoming else 0
+
+    def _back_order(self):
+        return self.upcoming[-1].order + 1 if self.upcoming else 0
+
+    def _renumber(self):
+        for order, track in enumerate(self.upcoming):
+            track.order = order
+
+    def _enter(self, track):
+        track.queued = True
+        if track.duration is None:
+            self.unknown_durations += 1
+        else:
+            self.total_duration += track.duration
+
+    def _leave(self, track):
+        track.queued = False
+        if track.duration is None:
+            self.unknown_durations -= 1
+        else:
+            self.total_duration -= track.duration
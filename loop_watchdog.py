@@ -0,0 +1,116 @@
+# Standard library imports
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+ASYNCIO_DIR = os.path.dirname(asyncio.__file__)
+
+
+class Stall:
+    """
+    A time the event loop was blocked for longer than the watchdog's threshold.
+    """
+    __slots__ = ('started_at', 'duration', 'task', 'stack')
+
+    def __init__(self, started_at, duration, task, stack):
+        self.started_at = started_at
+        self.duration = duration
+        # The name of the task that was running, if the loop was running one
+        self.task = task
+        # The stack of the event loop thread, captured while it was blocked
+        self.stack = stack
+
+
+class LoopWatchdog:
+    """
+    Watches an event loop from its own thread and records what blocks it.
+
+    Every ``interval`` seconds the watchdog schedules a no-op callback on the
+    loop and times how long the loop takes to run it. If that takes longer
+    than ``threshold`` seconds, something is hogging the loop, and the
+    watchdog captures the stack of the loop thread right then, so the log
+    shows the code that was running rather than the code that noticed.
+    Because the check runs on another thread, a fully blocked loop is still
+    caught, which a coroutine measuring its own lag can't do.
+    """
+
+    def __init__(self, threshold=0.1, interval=0.25, history=20):
+        """
+        :param threshold: The number of seconds the loop may take to respond before it counts as stalled
+        :param interval: The number of seconds between checks
+        :param history: The number of recent stalls to keep
+        """
+        self.threshold = threshold
+        self.interval = interval
+        self.stalls = deque(maxlen=history)
+        self.stall_count = 0
+        # The latest and the highest time the loop took to respond, in seconds
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self._loop = None
+        self._loop_thread_id = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self, loop=None):
+        """
+        Start watching a loop. Must be called from the thread running that loop.
+
+        :param loop: The loop to watch, by default the running one
+        """
+        self._loop = loop or asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='loop-watchdog', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            responded = threading.Event()
+            sent_at = time.perf_counter()
+            try:
+                self._loop.call_soon_threadsafe(responded.set)
+            except RuntimeError:
+                # The loop has been closed
+                break
+
+            stall = None
+            if not responded.wait(self.threshold):
+                stall = self._capture(sent_at)
+                while not responded.wait(1):
+                    if self._stopped.is_set() or self._loop.is_closed():
+                        return
+
+            self.lag = time.perf_counter() - sent_at
+            self.max_lag = max(self.max_lag, self.lag)
+            if stall is not None:
+                stall.duration = self.lag
+                self.stalls.append(stall)
+                self.stall_count += 1
+                log.warning("Event loop was blocked for %.0f ms (task %s) at:\n%s",
+                            stall.duration * 1000, stall.task, stall.stack)
+
+    def _capture(self, sent_at):
+        frame = sys._current_frames().get(self._loop_thread_id)
+        frames = traceback.extract_stack(frame) if frame is not None else []
+        # Start at the callback the loop is running, the frames of the loop itself say nothing
+        scheduler = [index for index, entry in enumerate(frames) if entry.filename.startswith(ASYNCIO_DIR)]
+        if scheduler and scheduler[-1] + 1 < len(frames):
+            frames = frames[scheduler[-1] + 1:]
+        stack = ''.join(traceback.format_list(frames))
+        try:
+            task = asyncio.current_task(self._loop)
+        except RuntimeError:
+            task = None
+        started_at = time.time() - (time.perf_counter() - sent_at)
+        return Stall(started_at, None, task.get_name() if task is not None else None, stack)
@@ -0,0 +1,57 @@
+# Standard library imports
+import json
+import logging
+import subprocess
+
+log = logging.getLogger(__name__)
+
+
+def measure_loudness(executable, filename, timeout=120):
+    """
+    Measure the integrated loudness and true peak of a file with FFmpeg's EBU R128 ``loudnorm`` filter.
+
+    This decodes the whole file, so it belongs in a background thread rather
+    than on the event loop.
+
+    :param executable: The path of the FFmpeg binary
+    :param filename: The audio file to measure
+    :param timeout: The number of seconds the analysis may take
+    :return: A dict with the integrated loudness ``input_i`` in LUFS and the true peak ``input_tp`` in dBTP,
+        or None if the file couldn't be measured
+    """
+    command = [executable, '-hide_banner', '-nostats', '-nostdin', '-i', filename, '-vn',
+               '-af', 'loudnorm=print_format=json', '-f', 'null', '-']
+    try:
+        process = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=timeout)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        log.warning("Unable to measure the loudness of %s: %s", filename, e)
+        return None
+
+    # The measurements are the last JSON object FFmpeg prints to stderr
+    output = process.stderr.decode('utf-8', 'replace')
+    start, end = output.rfind('{'), output.rfind('}')
+    if process.returncode != 0 or start == -1 or end < start:
+        log.warning("Unable to measure the loudness of %s, FFmpeg exited with %s", filename, process.returncode)
+        return None
+    try:
+        stats = json.loads(output[start:end + 1])
+        return {'input_i': float(stats['input_i']), 'input_tp': float(stats['input_tp'])}
+    except (ValueError, KeyError) as e:
+        log.warning("Unable to parse the loudness of %s: %s", filename, e)
+        return None
+
+
+def gain_for(loudness, target, true_peak):
+    """
+    Work out the gain that brings a track to the target loudness without clipping.
+
+    :param loudness: The measurements returned by ``measure_loudness``
+    :param target: The integrated loudness to aim for, in LUFS
+    :param true_peak: The highest true peak allowed after the gain, in dBTP
+    :return: The gain in dB, or None for silence, which has no meaningful loudness
+    """
+    if loudness is None or loudness['input_i'] == float('-inf') or loudness['input_i'] < -70:
+        return None
+    gain = target - loudness['input_i']
+    # Turning a loud track down is always safe, turning a quiet one up must leave headroom for its peaks
+    return round(min(gain, true_peak - loudness['input_tp']), 2)
@@ -1,47 +1,197 @@
 # Standard library imports
 import asyncio
+import itertools
 import json
+import logging
+import multiprocessing
 import os
-import random
-import traceback
-from collections import deque
+import time
 from datetime import datetime
 from pathlib import Path
-import multiprocessing
-import queue
+from urllib.parse import parse_qs, urlparse
 import signal
 
 # Third-party imports
 import discord
 import spotipy
-import yt_dlp as youtube_dl
 from discord.ext import commands
 from spotipy.oauth2 import SpotifyClientCredentials
-from discord.ui import Button, View
+from discord.ui import View
 
 # Local Files
-from ytdl_source import ytdl_format_options, ffmpeg_options
+from audio_cache import AudioCache, key_from_url, make_key
+from download_pool import DownloadPool
+from ffmpeg_supervisor import FFmpegSupervisor
+from guild_player import GuildPlayer, Track
+from loop_watchdog import LoopWatchdog
+from loudness import gain_for, measure_loudness
+import metrics
+from message_outbox import PRIORITY_INFO, PRIORITY_PLAYBACK, MessageOutbox
+from spotify_resolver import SpotifyResolver, parse_spotify_url
+from state_store import StateStore
+from ttl_cache import TTLCache
+from ytdl_pool import close_all, get_ytdl
+from ytdl_source import ffmpeg_options, ffmpeg_stream_options
 
 with open('settings.json', 'r') as f:
     settings = json.load(f)
 
 ENABLE_SPOTIFY = settings['ENABLE_SPOTIFY']
 ENABLE_YOUTUBE = settings['ENABLE_YOUTUBE']
-BUTTON_TIMEOUT = settings['BUTTON_TIMEOUT']
+DOWNLOAD_WORKER_MODE = settings.get('DOWNLOAD_WORKER_MODE', 'process')
+MIN_DOWNLOAD_WORKERS = settings.get('MIN_DOWNLOAD_WORKERS', 1)
+MAX_DOWNLOAD_WORKERS = settings.get('MAX_DOWNLOAD_WORKERS', 4)
+DOWNLOAD_WORKER_IDLE_TIMEOUT = settings.get('DOWNLOAD_WORKER_IDLE_TIMEOUT', 60)
+DOWNLOAD_TIMEOUT = settings.get('DOWNLOAD_TIMEOUT', 600)
+AUDIO_CACHE_DIR = str(Path(__file__).parent / settings.get('AUDIO_CACHE_DIR', 'cache'))
+AUDIO_CACHE_MAX_BYTES = settings.get('AUDIO_CACHE_MAX_BYTES', 2 * 1024 ** 3)
+PLAYBACK_MODE = settings.get('PLAYBACK_MODE', 'download')
+STREAM_CACHE_IN_BACKGROUND = settings.get('STREAM_CACHE_IN_BACKGROUND', True)
+PREFETCH_DEPTH = settings.get('PREFETCH_DEPTH', 2)
+PLAYLIST_CONCURRENCY = settings.get('PLAYLIST_CONCURRENCY', 4)
+MAX_PLAYLIST_LENGTH = settings.get('MAX_PLAYLIST_LENGTH', 500)
+SPOTIFY_CACHE_TTL = settings.get('SPOTIFY_CACHE_TTL', 86400)
+SEARCH_CACHE_TTL = settings.get('SEARCH_CACHE_TTL', 21600)
+TRANSITION_LATENCY_BUDGET_MS = settings.get('TRANSITION_LATENCY_BUDGET_MS', 200)
+MESSAGE_RATE_LIMIT = settings.get('MESSAGE_RATE_LIMIT', 5)
+MESSAGE_RATE_PERIOD = settings.get('MESSAGE_RATE_PERIOD', 5)
+MESSAGE_COALESCE_DELAY = settings.get('MESSAGE_COALESCE_DELAY', 0.5)
+QUEUE_PAGE_SIZE = settings.get('QUEUE_PAGE_SIZE', 10)
+QUEUE_VIEW_TIMEOUT = settings.get('QUEUE_VIEW_TIMEOUT', 300)
+STATE_DB_PATH = str(Path(__file__).parent / settings.get('STATE_DB_PATH', 'state.sqlite3'))
+STATE_FLUSH_INTERVAL = settings.get('STATE_FLUSH_INTERVAL', 1)
+LOG_LEVEL = settings.get('LOG_LEVEL', 'INFO')
+LOG_FORMAT = settings.get('LOG_FORMAT', 'text')
+METRICS_HOST = settings.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = settings.get('METRICS_PORT')
+FFMPEG_MAX_PROCESSES = settings.get('FFMPEG_MAX_PROCESSES', 64)
+FFMPEG_SLOT_TIMEOUT = settings.get('FFMPEG_SLOT_TIMEOUT', 15)
+FFMPEG_PRESPAWN_SECONDS = settings.get('FFMPEG_PRESPAWN_SECONDS', 5)
+LOUDNESS_NORMALIZATION = settings.get('LOUDNESS_NORMALIZATION', False)
+LOUDNESS_TARGET = settings.get('LOUDNESS_TARGET', -16)
+LOUDNESS_TRUE_PEAK = settings.get('LOUDNESS_TRUE_PEAK', -1.5)
+LOOP_STALL_THRESHOLD_MS = settings.get('LOOP_STALL_THRESHOLD_MS', 100)
+AUDIO_CACHE_JANITOR_INTERVAL = settings.get('AUDIO_CACHE_JANITOR_INTERVAL', 30)
+AUDIO_CACHE_EVICTION_BATCH = settings.get('AUDIO_CACHE_EVICTION_BATCH', 20)
+RESUME_SAVE_INTERVAL = settings.get('RESUME_SAVE_INTERVAL', 15)
+
+# shard_supervisor.py tells each process it starts which shards to run; without it, SHARD_COUNT shards
+# run in this one process, or the bot isn't sharded at all if that's unset too
+SHARD_COUNT = int(os.environ.get('MUSICBOT_SHARD_COUNT') or 0) or settings.get('SHARD_COUNT')
+SHARD_IDS = [int(shard_id) for shard_id in os.environ['MUSICBOT_SHARD_IDS'].split(',')] if os.environ.get('MUSICBOT_SHARD_IDS') else None
+PROCESS_INDEX = int(os.environ.get('MUSICBOT_PROCESS_INDEX', 0))
+PROCESS_COUNT = int(os.environ.get('MUSICBOT_PROCESS_COUNT', 1))
+if PROCESS_COUNT > 1:
+    # Every process keeps its own cache index, so give each a directory and a share of the space
+    AUDIO_CACHE_DIR = os.path.join(AUDIO_CACHE_DIR, f'process-{PROCESS_INDEX}')
+    AUDIO_CACHE_MAX_BYTES //= PROCESS_COUNT
+    if METRICS_PORT:
+        METRICS_PORT += PROCESS_INDEX
+
+log = logging.getLogger('musicbot')
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats log records as one JSON object per line, for log collectors.
+    """
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if PROCESS_COUNT > 1:
+            entry['process'] = PROCESS_INDEX
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+def configure_logging():
+    """
+    Send log records to stderr at ``LOG_LEVEL``, as text or as JSON lines depending on ``LOG_FORMAT``.
+    """
+    handler = logging.StreamHandler()
+    if LOG_FORMAT == 'json':
+        handler.setFormatter(JsonFormatter())
+    elif PROCESS_COUNT > 1:
+        # The supervisor interleaves the output of every process
+        handler.setFormatter(logging.Formatter(f'%(asctime)s %(levelname)s [process {PROCESS_INDEX}] %(name)s: %(message)s'))
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    logging.basicConfig(level=LOG_LEVEL, handlers=[handler])
+    # discord.py and yt-dlp are chatty below INFO
+    logging.getLogger('discord').setLevel(max(logging.INFO, logging.getLogger().level))
 
-# reset music folder
-for file in Path(__file__).parent.glob('*.mp3'):
-    file.unlink()
+# Backlog used for downloads nobody is waiting on, so they take turns with the guilds
+BACKGROUND_DOWNLOADS = 'background'
 
 intents = discord.Intents.default()
 intents.message_content = True
 
-bot = commands.Bot(command_prefix='?', intents=intents)
+if SHARD_COUNT:
+    # All of this process's shards share its event loop, download workers and guild state
+    bot = commands.AutoShardedBot(command_prefix='?', intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+else:
+    bot = commands.Bot(command_prefix='?', intents=intents)
+
+# The music queue and repeat settings of each guild
+players = {}
+
+# The playback buttons shared by every "Now playing" message, created in setup_hook
+player_controls = None
+
+# Normalized search query -> URL of the video it resolved to
+search_cache = TTLCache(SEARCH_CACHE_TTL)
+
+# Paces and merges the messages sent to each channel
+outbox = MessageOutbox(rate=MESSAGE_RATE_LIMIT, per=MESSAGE_RATE_PERIOD, coalesce_delay=MESSAGE_COALESCE_DELAY)
+
+# Starts and caps the FFmpeg processes used for playback
+ffmpeg_supervisor = FFmpegSupervisor(settings['ffmpeg_path'], file_options=ffmpeg_options, stream_options=ffmpeg_stream_options,
+                                     max_processes=FFMPEG_MAX_PROCESSES, slot_timeout=FFMPEG_SLOT_TIMEOUT)
+
+# Records anything that blocks the event loop for longer than LOOP_STALL_THRESHOLD_MS
+loop_watchdog = LoopWatchdog(threshold=LOOP_STALL_THRESHOLD_MS / 1000)
+
+# The task stopping the bot once a shutdown signal arrived
+shutdown_task = None
+
+# Cache keys of the tracks whose loudness is being measured in the background
+loudness_pending = set()
+
+# Whether the queues saved before the last shutdown have been restored
+state_restored = False
 
-# Add a music queue for each guild, repeat queue, and repeat song
-music_queues = {}
-repeat_queue = {}
-repeat_song = {}
+# Metrics served at METRICS_HOST:METRICS_PORT/metrics
+registry = metrics.Registry()
+search_seconds = registry.histogram('musicbot_search_seconds', 'Time yt-dlp took to look up a track', ['kind'])
+download_seconds = registry.histogram('musicbot_download_seconds', 'Time yt-dlp took to download a track')
+loudness_seconds = registry.histogram('musicbot_loudness_analysis_seconds', 'Time FFmpeg took to measure the loudness of a track')
+resolve_seconds = registry.histogram('musicbot_resolve_seconds', 'Time from queueing a lookup or download to its result, including the wait for a worker', ['mode'])
+cache_requests = registry.counter('musicbot_cache_requests_total', 'Cache lookups', ['cache', 'result'])
+time_to_first_audio = registry.histogram('musicbot_time_to_first_audio_seconds', 'Time from a ?play on an idle player to its audio starting')
+transition_seconds = registry.histogram('musicbot_transition_seconds', 'Time from the end of a track to the start of the next one')
+event_loop_lag = registry.histogram('musicbot_event_loop_lag_seconds', 'How late the event loop woke up a sleeping task')
+event_loop_lag_last = registry.gauge('musicbot_event_loop_lag_last_seconds', 'The latest event loop lag measurement')
+registry.collected('musicbot_event_loop_stalls_total', 'Times the event loop was blocked for longer than the stall threshold', 'counter', [],
+                   lambda: [((), loop_watchdog.stall_count)])
+registry.collected('musicbot_queue_depth', 'Number of queued tracks, including the current one', 'gauge', ['guild'],
+                   lambda: [((guild_id,), len(player)) for guild_id, player in players.items()])
+registry.collected('musicbot_ffmpeg_processes', 'Number of running FFmpeg processes', 'gauge', [],
+                   lambda: [((), ffmpeg_supervisor.running)])
+registry.collected('musicbot_ffmpeg_waiting', 'Number of tracks waiting for an FFmpeg slot', 'gauge', [],
+                   lambda: [((), ffmpeg_supervisor.waiting)])
+registry.collected('musicbot_ffmpeg_cpu_seconds_total', 'CPU time used by FFmpeg processes', 'counter', [],
+                   lambda: [((), ffmpeg_supervisor.finished_cpu_seconds + sum(stats['cpu_seconds'] for stats in ffmpeg_supervisor.stats()))])
+registry.collected('musicbot_ffmpeg_rss_bytes', 'Resident memory of the running FFmpeg processes', 'gauge', [],
+                   lambda: [((), sum(stats['rss_bytes'] for stats in ffmpeg_supervisor.stats()))])
+registry.collected('musicbot_download_workers', 'Number of download workers', 'gauge', [],
+                   lambda: [((), download_pool.size)])
+registry.collected('musicbot_audio_cache_bytes', 'Size of the audio cache on disk', 'gauge', [],
+                   lambda: [((), audio_cache.size)])
+registry.collected('musicbot_audio_cache_evictions_total', 'Tracks evicted from the audio cache', 'counter', [],
+                   lambda: [((), audio_cache.evictions)])
 
 # bot ready event
 @bot.event
@@ -49,7 +199,108 @@ async def on_ready():
     """
     Event handler that runs when the bot is ready and connected to Discord.
     """
-    print(f'{bot.user.name} has connected to Discord!')
+    global state_restored
+    log.info("%s has connected to Discord", bot.user.name)
+    # on_ready runs again after every reconnect, only restore once
+    if not state_restored:
+        state_restored = True
+        await restore_state()
+
+@bot.event
+async def setup_hook():
+    """
+    Runs once before the bot connects. Registers the playback buttons,
+    starts the tasks that deliver download results, save the queues and
+    playback positions, clean up the audio cache and measure event loop lag, starts the loop watchdog, hooks up the shutdown
+    signals and serves the metrics.
+    """
+    global player_controls
+    player_controls = PlayerControls()
+    bot.add_view(player_controls)
+    bot.loop.create_task(download_pool.deliver_results())
+    bot.loop.create_task(state_store.run(snapshot_guild))
+    bot.loop.create_task(save_positions())
+    bot.loop.create_task(audio_cache.run(queued_cache_keys, interval=AUDIO_CACHE_JANITOR_INTERVAL,
+                                         batch=AUDIO_CACHE_EVICTION_BATCH))
+    bot.loop.create_task(metrics.measure_event_loop_lag(event_loop_lag, event_loop_lag_last))
+    if LOOP_STALL_THRESHOLD_MS:
+        loop_watchdog.start(bot.loop)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            bot.loop.add_signal_handler(signum, request_shutdown)
+        except NotImplementedError:
+            # The Windows event loop has no signal handlers, hand over to the loop from a plain one instead
+            signal.signal(signum, lambda signum, frame: bot.loop.call_soon_threadsafe(request_shutdown))
+    if METRICS_PORT:
+        try:
+            await registry.serve(METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            # Metrics are nice to have, the bot runs without them
+            log.error("Unable to serve metrics on %s:%s, continuing without them: %s", METRICS_HOST, METRICS_PORT, e)
+
+def snapshot_guild(guild_id):
+    """
+    Collect the state of a guild that is saved across restarts.
+
+    :param guild_id: The ID of the guild
+    :return: A ``(guild_row, tracks)`` tuple for ``StateStore``, or None if there is nothing to save
+    """
+    player = players.get(guild_id)
+    if player is None or (len(player) == 0 and not player.history):
+        return None
+    guild = bot.get_guild(guild_id)
+    voice_client = guild.voice_client if guild else None
+    voice_channel_id = voice_client.channel.id if voice_client and voice_client.channel else None
+    text_channel_id = player.channel.id if player.channel else None
+    current_offset = None
+    if player.current is not None:
+        current_offset = player.current.start_at if player.current.start_at is not None else player.position
+    guild_row = (voice_channel_id, text_channel_id, player.repeat_queue, player.repeat_song, current_offset)
+    # Walked only when every track is written, the other writes take just the tracks that changed
+    return guild_row, itertools.chain(player, player.history)
+
+async def restore_state():
+    """
+    Bring back the queues saved before the last shutdown and resume playback.
+
+    Only guilds the bot was in a voice channel of are restored, and only if
+    someone is still in that channel. Tracks keep their cache key, so the
+    ones already in the audio cache start without downloading again, and
+    the current track picks up where it was.
+    """
+    saved = state_store.load()
+    for guild_id, state in saved.items():
+        if not handles_guild(guild_id):
+            # The database is shared by every process, leave other shards' guilds to them
+            continue
+        guild = bot.get_guild(guild_id)
+        voice_channel = guild.get_channel(state['voice_channel_id']) if guild and state['voice_channel_id'] else None
+        text_channel = guild.get_channel(state['text_channel_id']) if guild and state['text_channel_id'] else None
+        if (voice_channel is None or text_channel is None
+                or not any(not member.bot for member in voice_channel.members)):
+            state_store.mark_dirty(guild_id)  # Forget it
+            continue
+
+        def to_track(row):
+            track = Track(row['query'], guild_id, title=row['title'], spotify_id=row['spotify_id'], duration=row['duration'])
+            track.key = row['key'] or track.key
+            return track
+
+        player = get_player(guild_id)
+        player.load(to_track(state['current']) if state['current'] else None,
+                    [to_track(row) for row in state['upcoming']], [to_track(row) for row in state['history']])
+        player.repeat_queue, player.repeat_song = state['repeat_queue'], state['repeat_song']
+        if player.current is not None and state['current_offset']:
+            player.current.start_at = state['current_offset']
+        try:
+            if guild.voice_client is None:
+                await voice_channel.connect()
+        except (discord.ClientException, asyncio.TimeoutError) as e:
+            log.error("Error reconnecting to voice channel %s in guild %s: %s", voice_channel.id, guild_id, e)
+            player.reset()
+            continue
+        log.info("Restored %d queued songs in guild %s", len(player), guild_id)
+        start_player(guild, text_channel)
 
 # Modify the on_voice_state_update event to use the new function
 @bot.event
@@ -62,10 +313,17 @@ async def on_voice_state_update(member, before, after):
     :param before: The voice state before the change
     :param after: The voice state after the change
     """
+    if member.id == bot.user.id:
+        # The saved state remembers which voice channel to rejoin
+        state_store.mark_dirty(member.guild.id)
+        if after.channel is None and member.guild.id in players:
+            # Disconnected, e.g. by a moderator, so resume from here once the bot is back
+            stop_player(players[member.guild.id])
     voice_client = member.guild.voice_client
     if voice_client:
         if len(voice_client.channel.members) == 1:
-            music_queues[member.guild.id].clear()
+            if member.guild.id in players:
+                players[member.guild.id].reset()
             await voice_client.disconnect()
 
 # join/quit command
@@ -78,7 +336,7 @@ async def join(ctx):
     """
     if not ctx.message.author.voice:
         embed = discord.Embed(title=f"{ctx.message.author.name} is not connected to a voice channel", color=discord.Color.blue())
-        await ctx.send(embed=embed)
+        outbox.post(ctx.channel, embed, key='join')
         return
     else:
         channel = ctx.message.author.voice.channel
@@ -93,202 +351,435 @@ async def leave(ctx):
     """
     voice_client = ctx.message.guild.voice_client
     if voice_client and voice_client.is_connected():
+        # Keep the queue, so the current song picks up where it left off next time
+        stop_player(get_player(ctx.guild.id))
         await voice_client.disconnect()
     else:
         embed = discord.Embed(title="The bot is not connected to a voice channel.", color=discord.Color.blue())
-        await ctx.send(embed=embed)
+        outbox.post(ctx.channel, embed, key='leave')
 
 # song manipulation commands
 @bot.command(name='play', help='To play song or add to queue')
 async def play(ctx, url):
+    started_at = time.perf_counter()
     try:
         voice_client = ctx.message.guild.voice_client
         
         if not voice_client:
             if ctx.author.voice:
                 channel = ctx.author.voice.channel
-                if ctx.guild.id in music_queues:
-                    music_queues[ctx.guild.id].clear() 
-
+                # Keep the queue from before ?leave, start_player below resumes the current song where it stopped
                 voice_client = await channel.connect()
             else:
                 embed = discord.Embed(title="You need to be in a voice channel to use this command.", color=discord.Color.blue())
-                await ctx.send(embed=embed)
+                outbox.post(ctx.channel, embed, key='join')
                 return
 
         guild_id = ctx.guild.id
-        if guild_id not in music_queues:
-            music_queues[guild_id] = deque()
-
+        title, spotify_id = None, None
         async with ctx.typing():
             if "spotify.com" in url and ENABLE_SPOTIFY:
-                track_name, artist_name = get_spotify_track_info(url)
-                query = f"{track_name} {artist_name}"
+                kind, spotify_id = parse_spotify_url(url)
+                if kind in ('playlist', 'album'):
+                    await enqueue_playlist(ctx, spotify.iterate_collection(kind, spotify_id))
+                    return
+                title = await spotify.get_query(spotify_id)
+                # Tracks matched before go straight to their YouTube video, skipping ytsearch
+                query = spotify.get_match(spotify_id)
+                cache_requests.labels('spotify_match', 'miss' if query is None else 'hit').inc()
+                query = query or title
             elif ENABLE_YOUTUBE:
+                if is_youtube_playlist(url):
+                    await enqueue_playlist(ctx, iterate_youtube_playlist(url))
+                    return
                 query = url
             else:
                 embed = discord.Embed(title="Error:", description=f"Unable to process {url}. Please try another URL.", color=discord.Color.blue())
-                await ctx.send(embed=embed)
+                outbox.post(ctx.channel, embed)
                 return
 
-            # Use multiprocessing to download music and put guild_id in task_queue
-            task_queue.put((query, guild_id))
-            
-            # Wait for the download to complete
-            while True:
-                try:
-                    title, filename, processed_guild_id = music_queue.get_nowait()
-                    if processed_guild_id == guild_id:
-                        break
-                    else:
-                        # Put back the item if it's for a different guild
-                        music_queue.put((title, filename, processed_guild_id))
-                except queue.Empty:
-                    await asyncio.sleep(1)  # Wait for a second before checking again
-
-        if filename is None:
-            embed = discord.Embed(title="Error:", description=f"Unable to get filename for {url}. Please try another URL.", color=discord.Color.blue())
-            await ctx.send(embed=embed)
-            return
+        # Queue the track right away and let the prefetcher download it
+        track = Track(query, guild_id, title=title, spotify_id=spotify_id)
+        player = get_player(guild_id)
+        if len(player) == 0:
+            # Nothing to wait for, so the time until this track starts is what the user sees
+            track.requested_at = started_at
+        player.add(track)
+        prefetch(guild_id)
 
-        music_queues[guild_id].append((title, filename))
-        
-        embed = discord.Embed(title='Added to queue:', description=title, color=discord.Color.blue())
-        await ctx.send(embed=embed)
+        # Songs queued in quick succession are listed in one message
+        embed = discord.Embed(title='Added to queue:', description=track.title, color=discord.Color.blue())
+        outbox.post(ctx.channel, embed, priority=PRIORITY_INFO, key='added', merge=True)
 
-        if not voice_client.is_playing():
-            await play_next(ctx)
+        start_player(ctx.guild, ctx.channel)
 
     except Exception as e:
         if str(e) != 'Already playing audio.':
             embed = discord.Embed(title="An error occurred:", description=str(e), color=discord.Color.blue())
-            await ctx.send(embed=embed)
-            traceback.print_exc()
+            outbox.post(ctx.channel, embed)
+            log.exception("Error in ?play %s", url)
 
-async def play_next(ctx):
+async def enqueue_playlist(ctx, batches):
     """
-    Play the next song in the queue.
-    
+    Queue every entry of a playlist or album as it comes in.
+
+    Playback starts as soon as the first entry is ready, while the rest of
+    the list is still being fetched and downloaded.
+
     :param ctx: The context of the command invocation
+    :param batches: An async iterator yielding lists of ``(query, title, spotify_id, duration)`` entries
     """
     guild_id = ctx.guild.id
-    if guild_id in music_queues and music_queues[guild_id]:
-        voice_client = ctx.voice_client
-        
-        current_song = music_queues[guild_id][0]
-        title, filename = current_song
-        print(f"\nDebug: Current queue: {music_queues[guild_id]}\nCurrent song: {title}\n")
-        
-        if filename is None:
-            print(f"Error: Filename is None for song '{title}'")
-            embed = discord.Embed(title="Error:", description=f"Unable to play '{title}'. Skipping to next song.", color=discord.Color.blue())
-            await ctx.send(embed=embed)
-            await play_next(ctx)
+    added = 0
+    async for entries in batches:
+        entries = entries[:MAX_PLAYLIST_LENGTH - added]
+        tracks = [Track(query, guild_id, title=title, spotify_id=spotify_id, duration=duration)
+                  for query, title, spotify_id, duration in entries]
+        get_player(guild_id).extend(tracks)
+        prefetch(guild_id)
+        bot.loop.create_task(resolve_playlist(tracks))
+        added += len(tracks)
+
+        start_player(ctx.guild, ctx.channel)
+        if added >= MAX_PLAYLIST_LENGTH:
+            break
+
+    if added:
+        embed = discord.Embed(title='Added to queue:', description=f"{added} songs", color=discord.Color.blue())
+        outbox.post(ctx.channel, embed, priority=PRIORITY_INFO, key='added', merge=True)
+    else:
+        embed = discord.Embed(title="Error:", description="Unable to find any songs in that playlist.", color=discord.Color.blue())
+        outbox.post(ctx.channel, embed)
+
+async def resolve_playlist(tracks):
+    """
+    Resolve the entries of a playlist in order, ``PLAYLIST_CONCURRENCY`` at a time.
+
+    :param tracks: The queued tracks of the playlist
+    """
+    semaphore = asyncio.Semaphore(PLAYLIST_CONCURRENCY)
+
+    async def resolve(track):
+        async with semaphore:
+            # Skip entries that were removed or cleared from the queue in the meantime
+            if track not in get_player(track.guild_id):
+                return
+            if track.task is None:
+                track.task = bot.loop.create_task(resolve_track(track))
+            await track.task
+
+    await asyncio.gather(*map(resolve, tracks), return_exceptions=True)
+
+async def run_player(guild):
+    """
+    Play through a guild's queue until it runs out or the bot leaves the voice channel.
+
+    Each pass of the loop plays one track and then waits for it to end, so
+    skipping over any number of broken tracks never grows the stack.
+    Messages go to the channel of the latest command that queued something.
+
+    :param guild: The guild to play in
+    """
+    player = get_player(guild.id)
+    while True:
+        if player.current is None:
+            player.advance()
+        track = player.current
+        if track is None:
+            discard_prepared(player)
+            # Nothing follows the last track, so the wait until the next ?play is no transition
+            player.ended_at = None
+            embed = discord.Embed(title="The queue is empty.", color=discord.Color.blue())
+            outbox.post(player.channel, embed, priority=PRIORITY_PLAYBACK)
             return
 
-        try:
-            absolute_filename = os.path.abspath(filename)
-            print(f"Debug: Playing {absolute_filename} with FFmpeg at {settings['ffmpeg_path']}")
-            player = discord.FFmpegPCMAudio(absolute_filename, **ffmpeg_options, executable=settings['ffmpeg_path'])
-        
-        except Exception as e:
-            print(f"Error creating FFmpegPCMAudio for '{title}': {e}")
-            traceback.print_exc()
-            embed = discord.Embed(title="Error:", description=f"Unable to play '{title}'. Skipping to next song.", color=discord.Color.blue())
-            await ctx.send(embed=embed)
-            await play_next(ctx)
+        # Make sure the songs after this one are downloading while it plays
+        prefetch(guild.id)
+        if not track.task.done():
+            # Waited on rather than awaited, so stopping the player doesn't abort the download
+            # and a resolve that raised doesn't end the player
+            await asyncio.wait([track.task])
+        if guild.voice_client is None:
+            discard_prepared(player)
+            player.ended_at = None
             return
-        
-        def after_playing(error):
-            if error:
-                print(f'Player error: {error}')
-                traceback.print_exc()
-            
-            if not repeat_song.get(guild_id, False):
-                if not hasattr(ctx, 'skip_direction'):
-                    ctx.skip_direction = "next"
-
-                print(f"Debug: skip_direction: {ctx.skip_direction}")
-
-                if repeat_queue.get(guild_id, False):
-                    if ctx.skip_direction == "back":
-                        # Move the played song to the end of the queue
-                        played_song = music_queues[guild_id].pop()
-                        music_queues[guild_id].appendleft(played_song)
-                    if ctx.skip_direction == "next":
-                        # Move the played song to the end of the queue
-                        played_song = music_queues[guild_id].popleft()
-                        music_queues[guild_id].append(played_song)
-                else:
-                    # Remove the played song if not in repeat queue mode
-                    if ctx.skip_direction == "back":
-                        music_queues[guild_id].popleft()
-                        # Move the played song to the end of the queue
-                        played_song = music_queues[guild_id].pop()
-                        music_queues[guild_id].appendleft(played_song)
-                    if ctx.skip_direction == "next":
-                        music_queues[guild_id].pop()
-            
-            # # Use the skip direction if set, otherwise default to "next"
-            # next_direction = getattr(ctx, 'skip_direction', 'next')
-            asyncio.run_coroutine_threadsafe(play_next(ctx), bot.loop)
-        
-        voice_client.play(player, after=after_playing)
-        
-        # Create buttons for pause, skip, and repeat
-        pause_button = Button(label="⏸️", style=discord.ButtonStyle.primary, custom_id="pause_button")
-        skip_button = Button(label="⏩️", style=discord.ButtonStyle.primary, custom_id="skip_button")
-        repeat_queue_button = Button(label="Queue 🔄", style=discord.ButtonStyle.primary, custom_id="repeat_queue_button")
-        repeat_song_button = Button(label="Song 🔂️", style=discord.ButtonStyle.primary, custom_id="repeat_song_button")
-
-        async def pause_button_callback(interaction: discord.Interaction):
-            if interaction.user.voice and interaction.user.voice.channel:
-                await interaction.response.defer()
-                await pause_resume(ctx)
-            else:
-                embed = discord.Embed(title="You need to be in a voice channel to use this command.", color=discord.Color.blue())
-                await ctx.send(embed=embed)
 
-        async def skip_button_callback(interaction: discord.Interaction):
-            if interaction.user.voice and interaction.user.voice.channel:
-                await interaction.response.defer()
-                await skip(ctx)
-            else:
-                embed = discord.Embed(title="You need to be in a voice channel to use this command.", color=discord.Color.blue())
-                await ctx.send(embed=embed)
-        
-        async def repeat_queue_button_callback(interaction: discord.Interaction):
-            if interaction.user.voice and interaction.user.voice.channel:
-                await interaction.response.defer()
-                await repeat_queue_toggle(ctx)
+        log.debug("Playing %r in guild %s, %d songs queued", track.title, guild.id, len(player))
+        offset = track.start_at or 0
+        prepared, player.prepared = player.prepared, None
+        if prepared is not None and prepared[0] is track and not offset:
+            source = prepared[1]
+        else:
+            if prepared is not None:
+                prepared[1].cleanup()
+            if resolve_failed(track):
+                log.error("Error resolving %r", track.query,
+                          exc_info=None if track.task.cancelled() else track.task.exception())
+                source = None
             else:
-                embed = discord.Embed(title="You need to be in a voice channel to use this command.", color=discord.Color.blue())
-                await ctx.send(embed=embed)
+                source = await open_track_source(track, offset=offset)
+        voice_client = guild.voice_client
+        if voice_client is None:
+            if source is not None:
+                source.cleanup()
+            player.ended_at = None
+            return
+
+        if source is None:
+            embed = discord.Embed(title="Unable to play, skipping:", description=track.title, color=discord.Color.blue())
+            outbox.post(player.channel, embed, priority=PRIORITY_INFO, key='unplayable', merge=True)
+            player.drop_current()
+            continue
 
-        async def repeat_song_button_callback(interaction: discord.Interaction):
-            if interaction.user.voice and interaction.user.voice.channel:
-                await interaction.response.defer()
-                await repeat_song_toggle(ctx)
+        def after_playing(error, player=player):
+            if error:
+                log.error("Player error: %s", error)
+            # This runs on the audio thread, so hand over to the event loop
+            bot.loop.call_soon_threadsafe(player.finish_track, time.perf_counter())
+
+        player.track_finished.clear()
+        voice_client.play(source, after=after_playing)
+        track.start_at = None
+        player.playback_started(offset)
+        log_transition(player, track)
+        if track.requested_at is not None:
+            time_to_first_audio.observe(time.perf_counter() - track.requested_at)
+            track.requested_at = None
+        send_now_playing(player, track.title)
+
+        await wait_for_track_end(player, track)
+        player.playback_stopped()
+        direction = player.skip_direction or 'finished'
+        player.skip_direction = None
+        log.debug("Track ended in guild %s, moving on: %s", guild.id, direction)
+        if direction != 'seek':
+            player.advance(direction)
+
+def resolve_failed(track):
+    """
+    Check whether resolving a track raised instead of finishing.
+
+    :param track: A track whose resolve task is done
+    :return: True if the task raised or was cancelled
+    """
+    return track.task.cancelled() or track.task.exception() is not None
+
+async def open_track_source(track, wait=True, offset=0):
+    """
+    Start the FFmpeg process of a resolved track.
+
+    :param track: The track to play
+    :param wait: Whether to wait for a free FFmpeg slot
+    :param offset: The position in seconds to start from
+    :return: The audio source, or None if the track can't be played or no slot is free
+    """
+    if track.filename is None:
+        log.error("Filename is None for song %r", track.title)
+        return None
+    # Prefer the cached file once a streamed track has finished downloading in the background
+    cached = audio_cache.get(track.key)
+    if not cached and not track.filename.startswith(('http://', 'https://')) and not os.path.isfile(track.filename):
+        # Evicted since it was resolved, e.g. a played track gone back to with "?skip back"
+        if not wait:
+            return None
+        log.info("The file of %r is gone, resolving it again", track.title)
+        track.filename = None
+        track.task = bot.loop.create_task(resolve_track(track))
+        await asyncio.wait([track.task])
+        if resolve_failed(track) or track.filename is None:
+            return None
+        cached = audio_cache.get(track.key)
+    if cached:
+        filename, codec, gain = cached['filename'], cached.get('codec'), cached.get('gain')
+    else:
+        filename, codec, gain = track.filename, track.codec, track.gain
+    try:
+        return await ffmpeg_supervisor.open(filename, codec, gain=gain, offset=offset, wait=wait)
+    except Exception as e:
+        log.exception("Error creating FFmpegOpusAudio for %r: %s", track.title, e)
+        return None
+
+async def wait_for_track_end(player, track):
+    """
+    Wait for the current track to end, starting the next track's decoder shortly before it does.
+
+    The decoder is started ``FFMPEG_PRESPAWN_SECONDS`` before the end, so
+    FFmpeg has already started and buffered audio by the time it's needed.
+    Tracks of unknown length are not prepared ahead, and neither is the
+    next track while this one is paused, so its FFmpeg process doesn't hold
+    a slot for the whole pause.
+
+    :param player: The player of the guild
+    :param track: The track that is playing
+    """
+    if track.duration is not None and FFMPEG_PRESPAWN_SECONDS > 0:
+        while not player.track_finished.is_set():
+            if player.resumed_at is None:
+                # Paused, check again shortly
+                delay = 1
             else:
-                embed = discord.Embed(title="You need to be in a voice channel to use this command.", color=discord.Color.blue())
-                await ctx.send(embed=embed)
+                # Worked out again every time, since a pause or a seek moves the end
+                delay = track.duration - player.position - FFMPEG_PRESPAWN_SECONDS
+                if delay <= 0:
+                    await prepare_next(player)
+                    break
+            try:
+                await asyncio.wait_for(player.track_finished.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+    await player.track_finished.wait()
+
+async def prepare_next(player):
+    """
+    Start the decoder of the track that plays next, if it's ready and an FFmpeg slot is free.
+
+    :param player: The player of the guild
+    """
+    upcoming = player.peek_next()
+    if (upcoming is None or upcoming.task is None or not upcoming.task.done() or player.prepared is not None
+            or upcoming.start_at or resolve_failed(upcoming)):
+        return
+    # Never hold up a track that has to start now for one that only might
+    source = await open_track_source(upcoming, wait=False)
+    if source is not None:
+        player.prepared = (upcoming, source)
+
+def discard_prepared(player):
+    """
+    Stop the decoder started ahead of time for a guild, if any.
+
+    :param player: The player of the guild
+    """
+    if player.prepared is not None:
+        player.prepared[1].cleanup()
+        player.prepared = None
+
+def stop_player(player):
+    """
+    Stop the player task of a guild, keeping the current track and the position it had reached.
+
+    :param player: The player of the guild
+    """
+    if player.task is None or player.task.done():
+        return
+    if player.current is not None and player.current.start_at is None and player.position:
+        player.current.start_at = player.position
+    player.task.cancel()
+    discard_prepared(player)
+    player.playback_stopped()
+    player.ended_at = None
+    state_store.mark_dirty(player.guild_id)
+
+async def save_positions():
+    """
+    Save the playback position of the guilds that are playing every ``RESUME_SAVE_INTERVAL`` seconds, until cancelled.
+
+    The playback position moves without any queue change, so without this
+    a crash would resume the current track from wherever it was last saved.
+    Only the position is written, the rest of the guild's state is left alone.
+    """
+    if not RESUME_SAVE_INTERVAL:
+        return
+    while True:
+        await asyncio.sleep(RESUME_SAVE_INTERVAL)
+        offsets = [(guild_id, player.position) for guild_id, player in players.items() if player.resumed_at is not None]
+        if offsets:
+            await state_store.save_offsets(offsets)
+
+def start_player(guild, channel):
+    """
+    Start the player task of a guild unless it is already running.
+
+    :param guild: The guild to play in
+    :param channel: The channel messages about playback go to
+    """
+    player = get_player(guild.id)
+    if player.channel != channel:
+        player.channel = channel
+        state_store.mark_dirty(guild.id)
+    if player.task is None or player.task.done():
+        # The track stopped by stop_player still reports its end afterwards, which is no transition either
+        player.ended_at = None
+        player.task = bot.loop.create_task(run_player(guild))
+        player.task.add_done_callback(report_player_error)
 
-        pause_button.callback = pause_button_callback
-        skip_button.callback = skip_button_callback
-        repeat_queue_button.callback = repeat_queue_button_callback
-        repeat_song_button.callback = repeat_song_button_callback
+def report_player_error(task):
+    """
+    Log the error a player task stopped with, if any.
 
-        view = View(timeout=settings['BUTTON_TIMEOUT'])
-        view.add_item(pause_button)
-        view.add_item(skip_button)
-        view.add_item(repeat_queue_button)
-        view.add_item(repeat_song_button)
+    :param task: The finished player task
+    """
+    if not task.cancelled() and task.exception() is not None:
+        error = task.exception()
+        log.error("Error in player task: %s", error, exc_info=(type(error), error, error.__traceback__))
 
-        embed = discord.Embed(title='Now playing:', description=title, color=discord.Color.blue())
-        await ctx.send(embed=embed, view=view)
+def log_transition(player, track):
+    """
+    Log how long it took to go from the end of the previous track to the start of this one.
+
+    :param player: The player of the guild
+    :param track: The track that just started
+    """
+    if player.ended_at is None:
+        return
+    latency = time.perf_counter() - player.ended_at
+    player.ended_at = None
+    transition_seconds.observe(latency)
+    latency_ms = latency * 1000
+    if latency_ms > TRANSITION_LATENCY_BUDGET_MS:
+        log.warning("Transition to %r took %.0f ms (budget %d ms)", track.title, latency_ms, TRANSITION_LATENCY_BUDGET_MS)
     else:
-        embed = discord.Embed(title="The queue is empty.", color=discord.Color.blue())
-        await ctx.send(embed=embed)
+        log.debug("Transition to %r took %.1f ms", track.title, latency_ms)
+
+def send_now_playing(player, title):
+    """
+    Show the track that is playing, editing the "Now playing" message of the channel in place when there is one.
+
+    :param player: The player of the guild
+    :param title: The title of the track
+    """
+    embed = discord.Embed(title='Now playing:', description=title, color=discord.Color.blue())
+    outbox.post(player.channel, embed, priority=PRIORITY_PLAYBACK, key='now_playing', edit=True, view=player_controls)
+
+class PlayerControls(View):
+    """
+    The playback buttons under the "Now playing" message.
+
+    A single instance is registered with ``bot.add_view`` and shared by every
+    guild. The buttons have fixed custom IDs and act on the guild the click
+    came from, so they keep working across tracks and restarts. Clicks are
+    answered through the outbox like the matching commands, so repeated
+    clicks are merged into one reply.
+    """
+    def __init__(self):
+        super().__init__(timeout=None)
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        if interaction.user.voice and interaction.user.voice.channel:
+            return True
+        embed = discord.Embed(title="You need to be in a voice channel to use this command.", color=discord.Color.blue())
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+        return False
+
+    @discord.ui.button(label="⏸️", style=discord.ButtonStyle.primary, custom_id="player:pause")
+    async def pause_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await interaction.response.defer()
+        outbox.post(interaction.channel, toggle_pause(interaction.guild), key='pause')
+
+    @discord.ui.button(label="⏩️", style=discord.ButtonStyle.primary, custom_id="player:skip")
+    async def skip_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await interaction.response.defer()
+        outbox.post(interaction.channel, skip_track(interaction.guild), key='skip')
+
+    @discord.ui.button(label="Queue 🔄", style=discord.ButtonStyle.primary, custom_id="player:repeat_queue")
+    async def repeat_queue_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await interaction.response.defer()
+        outbox.post(interaction.channel, toggle_repeat_queue(interaction.guild), key='repeat_queue')
+
+    @discord.ui.button(label="Song 🔂️", style=discord.ButtonStyle.primary, custom_id="player:repeat_song")
+    async def repeat_song_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await interaction.response.defer()
+        outbox.post(interaction.channel, toggle_repeat_song(interaction.guild), key='repeat_song')
 
 @bot.command(name='pause', help='Pause or resume the song')
 async def pause_resume(ctx):
@@ -297,22 +788,29 @@ async def pause_resume(ctx):
     
     :param ctx: The context of the command invocation
     """
-    voice_client = ctx.message.guild.voice_client
+    outbox.post(ctx.channel, toggle_pause(ctx.guild), key='pause')
+
+def toggle_pause(guild):
+    """
+    Pause the currently playing audio of a guild, or resume it if paused.
+
+    :param guild: The guild to pause or resume playback in
+    :return: The embed describing the result
+    """
+    voice_client = guild.voice_client
     if voice_client:
         if voice_client.is_playing():
-            embed = discord.Embed(title="Paused the song.", color=discord.Color.blue())
-            await ctx.send(embed=embed)
-            await voice_client.pause()
+            voice_client.pause()
+            get_player(guild.id).playback_paused()
+            return discord.Embed(title="Paused the song.", color=discord.Color.blue())
         elif voice_client.is_paused():
-            embed = discord.Embed(title="Resumed the song.", color=discord.Color.blue())
-            await ctx.send(embed=embed)  
-            await voice_client.resume()
+            voice_client.resume()
+            get_player(guild.id).playback_resumed()
+            return discord.Embed(title="Resumed the song.", color=discord.Color.blue())
         else:
-            embed = discord.Embed(title="The bot is not playing anything at the moment.", color=discord.Color.blue())
-            await ctx.send(embed=embed) 
+            return discord.Embed(title="The bot is not playing anything at the moment.", color=discord.Color.blue())
     else:
-        embed = discord.Embed(title="The bot is not connected to a voice channel.", color=discord.Color.blue())
-        await ctx.send(embed=embed)
+        return discord.Embed(title="The bot is not connected to a voice channel.", color=discord.Color.blue())
 
 @bot.command(name='skip', help='Skip the current song')
 async def skip(ctx, direction: str = "next"):
@@ -322,23 +820,78 @@ async def skip(ctx, direction: str = "next"):
     :param ctx: The context of the command invocation
     :param direction: The direction to move in the queue ("next" or "back")
     """
-    # TODO "?skip back" doesn't work
+    outbox.post(ctx.channel, skip_track(ctx.guild, direction), key='skip')
+
+def skip_track(guild, direction="next"):
+    """
+    Skip the currently playing song of a guild.
+
+    :param guild: The guild to skip the song in
+    :param direction: The direction to move in the queue ("next" or "back")
+    :return: The embed describing the result
+    """
+    voice_client = guild.voice_client
+    if voice_client and (voice_client.is_playing() or voice_client.is_paused()):
+        # Set a flag to indicate the skip direction
+        get_player(guild.id).skip_direction = direction
+        voice_client.stop()  # This will trigger the after_playing callback
+        return discord.Embed(title=f"Skipped {'to previous' if direction == 'back' else 'the current'} song.", color=discord.Color.blue())
+    else:
+        return discord.Embed(title="The bot is not playing anything at the moment.", color=discord.Color.blue())
+
+@bot.command(name='seek', help='Jump to a position in the current song, e.g. 1:30, +30 or -10')
+async def seek(ctx, position: str):
+    """
+    Command to jump to a position in the currently playing song.
+
+    :param ctx: The context of the command invocation
+    :param position: An absolute position such as "1:30" or "90", or a relative one such as "+30" or "-10"
+    """
+    outbox.post(ctx.channel, seek_track(ctx.guild, position), key='seek')
+
+def seek_track(guild, position):
+    """
+    Restart the current song of a guild from another position.
+
+    :param guild: The guild to seek in
+    :param position: The position as given to ?seek
+    :return: The embed describing the result
+    """
+    voice_client = guild.voice_client
+    player = get_player(guild.id)
+    if not voice_client or player.current is None or not (voice_client.is_playing() or voice_client.is_paused()):
+        return discord.Embed(title="The bot is not playing anything at the moment.", color=discord.Color.blue())
     try:
-        voice_client = ctx.message.guild.voice_client
-        if voice_client and voice_client.is_playing():
-            # Set a flag to indicate the skip direction
-            ctx.skip_direction = direction
-            voice_client.stop()  # This will trigger the after_playing callback
-            embed = discord.Embed(title=f"Skipped {'to previous' if direction == 'back' else 'the current'} song.", color=discord.Color.blue())
-            await ctx.send(embed=embed)
-        else:
-            embed = discord.Embed(title="The bot is not playing anything at the moment.", color=discord.Color.blue())
-            await ctx.send(embed=embed)
-    except Exception as e:
-        if str(e) != 'Already playing audio.':
-            embed = discord.Embed(title="An error occurred:", description=str(e), color=discord.Color.blue())
-            await ctx.send(embed=embed)
-            traceback.print_exc()
+        offset = parse_position(position, player.position)
+    except ValueError:
+        return discord.Embed(title="Use a position like 1:30, 90, +30 or -10.", color=discord.Color.blue())
+    duration = player.current.duration
+    if duration is not None and offset >= duration:
+        return discord.Embed(title=f"The song is only {format_duration(duration)} long.", color=discord.Color.blue())
+    player.seek(offset)
+    voice_client.stop()  # The player restarts the song from the new position
+    return discord.Embed(title=f"Jumped to {format_duration(offset)}.", color=discord.Color.blue())
+
+def parse_position(text, current):
+    """
+    Parse a position given to ?seek.
+
+    :param text: "h:mm:ss", "m:ss" or a number of seconds, optionally prefixed with + or - to move relative to ``current``
+    :param current: The current position in seconds
+    :return: The position in seconds, never below zero
+    """
+    sign = text[:1] if text[:1] in '+-' else ''
+    parts = text[len(sign):].split(':')
+    if not 1 <= len(parts) <= 3 or not all(part.isdigit() for part in parts):
+        raise ValueError(text)
+    seconds = 0
+    for part in parts:
+        seconds = seconds * 60 + int(part)
+    if sign == '+':
+        seconds = current + seconds
+    elif sign == '-':
+        seconds = current - seconds
+    return max(0, seconds)
 
 # queue manipulation commands
 @bot.command(name='queue', help='Show the current music queue')
@@ -348,13 +901,101 @@ async def show_queue(ctx):
     
     :param ctx: The context of the command invocation
     """
-    if ctx.guild.id not in music_queues or len(music_queues[ctx.guild.id]) == 0:
+    player = get_player(ctx.guild.id)
+    if len(player) == 0:
         embed = discord.Embed(title="The queue is empty.", color=discord.Color.blue())
-        await ctx.send(embed=embed)
+        outbox.post(ctx.channel, embed, key='queue')
     else:
-        queue_list = "\n".join([f"{i+1}. {song[0]}" for i, song in enumerate(music_queues[ctx.guild.id])])
-        embed = discord.Embed(title="Current queue:", description=queue_list, color=discord.Color.blue())
-        await ctx.send(embed=embed)
+        view = QueueView(player)
+        outbox.post(ctx.channel, view.render(), key='queue', view=view, on_sent=view.attach)
+
+def format_duration(seconds):
+    """
+    Format a number of seconds as m:ss, or h:mm:ss from an hour up.
+
+    :param seconds: The duration in seconds
+    """
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}" if hours else f"{minutes}:{seconds:02}"
+
+class QueueView(View):
+    """
+    A page of a guild's queue with buttons to flip through the rest.
+
+    Only the tracks of the page on screen are looked at, and the page is
+    rendered again from the live queue on every click, so showing a long
+    queue costs the same as a short one.
+    """
+    def __init__(self, player):
+        super().__init__(timeout=QUEUE_VIEW_TIMEOUT)
+        self.player = player
+        self.page = 0
+        self.message = None
+
+    def attach(self, message):
+        """
+        Remember the message the view was sent with, so its buttons can be removed on timeout.
+
+        :param message: The sent message
+        """
+        self.message = message
+
+    @property
+    def page_count(self):
+        return max(1, -(-len(self.player.upcoming) // QUEUE_PAGE_SIZE))
+
+    def render(self):
+        """
+        Build the embed of the current page and enable the buttons that lead somewhere.
+        """
+        player = self.player
+        upcoming = player.upcoming
+        self.page = min(self.page, self.page_count - 1)
+        start = self.page * QUEUE_PAGE_SIZE
+        end = min(start + QUEUE_PAGE_SIZE, len(upcoming))
+
+        lines = []
+        if player.current is not None:
+            lines.append(f"Now playing: {player.current.title}{self.describe_duration(player.current)}")
+        # Indexing the deque skips straight to the page instead of walking every track before it
+        lines.extend(f"{position + 1}. {upcoming[position].title}{self.describe_duration(upcoming[position])}"
+                     for position in range(start, end))
+        embed = discord.Embed(title="Current queue:", description="\n".join(lines), color=discord.Color.blue())
+
+        if upcoming:
+            total = format_duration(player.total_duration)
+            if player.unknown_durations:
+                total += f" + {player.unknown_durations} of unknown length"
+            embed.set_footer(text=f"Page {self.page + 1}/{self.page_count} · Songs {start + 1}-{end} of "
+                                  f"{len(upcoming)} upcoming · Total length {total}")
+        else:
+            embed.set_footer(text="Nothing queued after this song")
+
+        self.previous_page.disabled = self.page == 0
+        self.next_page.disabled = self.page >= self.page_count - 1
+        return embed
+
+    @staticmethod
+    def describe_duration(track):
+        return f" ({format_duration(track.duration)})" if track.duration is not None else ""
+
+    @discord.ui.button(label="◀️", style=discord.ButtonStyle.primary)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page = max(0, self.page - 1)
+        await interaction.response.edit_message(embed=self.render(), view=self)
+
+    @discord.ui.button(label="▶️", style=discord.ButtonStyle.primary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page += 1
+        await interaction.response.edit_message(embed=self.render(), view=self)
+
+    async def on_timeout(self):
+        if self.message is not None:
+            try:
+                await self.message.edit(view=None)
+            except discord.HTTPException:
+                pass
 
 @bot.command(name='shuffle', help='Shuffle the current queue')
 async def shuffle(ctx):
@@ -363,21 +1004,54 @@ async def shuffle(ctx):
     
     :param ctx: The context of the command invocation
     """
-    def shuffle_queue(guild_id):
-        if guild_id in music_queues and len(music_queues[guild_id]) > 1:
-            current_song = music_queues[guild_id][0]
-            rest_of_queue = list(music_queues[guild_id])[1:]
-            random.shuffle(rest_of_queue)
-            music_queues[guild_id] = deque([current_song] + rest_of_queue)
-
     guild_id = ctx.guild.id
-    if guild_id in music_queues and music_queues[guild_id]:
-        shuffle_queue(guild_id)
+    player = get_player(guild_id)
+    if player.upcoming:
+        player.shuffle()
+        prefetch(guild_id)
         embed = discord.Embed(title="The queue has been shuffled.", color=discord.Color.blue())
-        await ctx.send(embed=embed)
     else:
         embed = discord.Embed(title="The queue is empty.", color=discord.Color.blue())
-        await ctx.send(embed=embed)
+    outbox.post(ctx.channel, embed, key='shuffle')
+
+@bot.command(name='remove', help='Remove a song from the queue')
+async def remove(ctx, position: int):
+    """
+    Command to remove an upcoming song from the queue.
+    
+    :param ctx: The context of the command invocation
+    :param position: The position of the song as shown by ?queue
+    """
+    try:
+        track = get_player(ctx.guild.id).remove(position)
+    except IndexError as e:
+        embed = discord.Embed(title="Error:", description=str(e), color=discord.Color.blue())
+        outbox.post(ctx.channel, embed, key='remove_error')
+        return
+    embed = discord.Embed(title="Removed from queue:", description=track.title, color=discord.Color.blue())
+    # Songs removed in a row are listed in one message
+    outbox.post(ctx.channel, embed, key='remove', merge=True)
+
+@bot.command(name='move', help='Move a song to another position in the queue')
+async def move(ctx, source: int, destination: int):
+    """
+    Command to move an upcoming song to another position in the queue.
+    
+    :param ctx: The context of the command invocation
+    :param source: The position of the song as shown by ?queue
+    :param destination: The position to move the song to
+    """
+    guild_id = ctx.guild.id
+    try:
+        track = get_player(guild_id).move(source, destination)
+    except IndexError as e:
+        embed = discord.Embed(title="Error:", description=str(e), color=discord.Color.blue())
+        outbox.post(ctx.channel, embed, key='move_error')
+        return
+    prefetch(guild_id)
+    embed = discord.Embed(title="Moved in queue:", description=f"{destination}. {track.title}", color=discord.Color.blue())
+    # Songs moved in a row are listed in one message
+    outbox.post(ctx.channel, embed, key='move', merge=True)
 
 @bot.command(name='clear', help='Clear the current queue')
 async def clear(ctx):
@@ -386,14 +1060,13 @@ async def clear(ctx):
     
     :param ctx: The context of the command invocation
     """
-    guild_id = ctx.guild.id
-    if guild_id in music_queues:
-        music_queues[guild_id].clear()
+    player = get_player(ctx.guild.id)
+    if player.upcoming:
+        player.clear()
         embed = discord.Embed(title="The queue has been cleared.", color=discord.Color.blue())
-        await ctx.send(embed=embed)
     else:
         embed = discord.Embed(title="The queue is empty.", color=discord.Color.blue())
-        await ctx.send(embed=embed)
+    outbox.post(ctx.channel, embed, key='clear')
 
 # repeat manipulation commands
 @bot.command(name='repeatqueue', help='Toggle repeat queue mode')
@@ -403,11 +1076,19 @@ async def repeat_queue_toggle(ctx):
     
     :param ctx: The context of the command invocation
     """
-    guild_id = ctx.guild.id
-    repeat_queue[guild_id] = not repeat_queue.get(guild_id, False)
-    status = "enabled" if repeat_queue[guild_id] else "disabled"
-    embed = discord.Embed(title=f"Repeat queue mode {status}", color=discord.Color.blue())
-    await ctx.send(embed=embed)
+    outbox.post(ctx.channel, toggle_repeat_queue(ctx.guild), key='repeat_queue')
+
+def toggle_repeat_queue(guild):
+    """
+    Toggle repeat queue mode of a guild.
+
+    :param guild: The guild to toggle the mode in
+    :return: The embed describing the result
+    """
+    player = get_player(guild.id)
+    player.repeat_queue = not player.repeat_queue
+    status = "enabled" if player.repeat_queue else "disabled"
+    return discord.Embed(title=f"Repeat queue mode {status}", color=discord.Color.blue())
 
 @bot.command(name='repeatsong', help='Toggle repeat song mode')
 async def repeat_song_toggle(ctx):
@@ -416,11 +1097,19 @@ async def repeat_song_toggle(ctx):
     
     :param ctx: The context of the command invocation
     """
-    guild_id = ctx.guild.id
-    repeat_song[guild_id] = not repeat_song.get(guild_id, False)
-    status = "enabled" if repeat_song[guild_id] else "disabled"
-    embed = discord.Embed(title=f"Repeat song mode {status}", color=discord.Color.blue())
-    await ctx.send(embed=embed)
+    outbox.post(ctx.channel, toggle_repeat_song(ctx.guild), key='repeat_song')
+
+def toggle_repeat_song(guild):
+    """
+    Toggle repeat song mode of a guild.
+
+    :param guild: The guild to toggle the mode in
+    :return: The embed describing the result
+    """
+    player = get_player(guild.id)
+    player.repeat_song = not player.repeat_song
+    status = "enabled" if player.repeat_song else "disabled"
+    return discord.Embed(title=f"Repeat song mode {status}", color=discord.Color.blue())
 
 # ping command
 @bot.command(name='ping', help='Test bot responsiveness')
@@ -434,82 +1123,391 @@ async def ping(ctx):
     message_timestamp = ctx.message.created_at
     current_time = datetime.now(message_timestamp.tzinfo)
     time_difference = current_time - message_timestamp
-    embed = discord.Embed(title='Pong!', description=f'Latency: {time_difference.total_seconds() * 1000:.2f} ms', color=discord.Color.blue())
+    # A sharded bot's latency is the average over its shards, show the one this guild is on
+    shard = bot.get_shard(ctx.guild.shard_id) if SHARD_COUNT else None
+    lines = [f'Message latency: {time_difference.total_seconds() * 1000:.2f} ms',
+             f'Gateway latency: {(shard.latency if shard else bot.latency) * 1000:.2f} ms']
+    if shard:
+        lines.append(f'Shard: {shard.id} of {shard.shard_count}')
+    voice_client = ctx.guild.voice_client
+    if voice_client:
+        lines.append(f'Voice latency: {voice_client.average_latency * 1000:.2f} ms')
+    embed = discord.Embed(title='Pong!', description='\n'.join(lines), color=discord.Color.blue())
+    await ctx.send(embed=embed)
+
+# lag command
+@bot.command(name='lag', help='Show event loop lag and recent stalls (bot owner only)')
+@commands.is_owner()
+async def lag(ctx, count: int = 3):
+    """
+    Command to show how responsive the event loop is and what blocked it lately.
+
+    Only the innermost frames of each stall are shown, the full stacks are in the log.
+
+    :param ctx: The context of the command invocation
+    :param count: The number of recent stalls to show
+    """
+    lines = [f'Current lag: {loop_watchdog.lag * 1000:.1f} ms',
+             f'Highest lag: {loop_watchdog.max_lag * 1000:.1f} ms',
+             f'Stalls over {LOOP_STALL_THRESHOLD_MS} ms: {loop_watchdog.stall_count}']
+    for stall in list(loop_watchdog.stalls)[-max(0, count):][::-1]:
+        ago = format_duration(time.time() - stall.started_at)
+        frames = '\n'.join(stall.stack.strip().splitlines()[-4:])
+        lines.append(f'\n**{stall.duration * 1000:.0f} ms**, {ago} ago, task `{stall.task}`\n```{frames[-700:]}```')
+    embed = discord.Embed(title='Event loop', description='\n'.join(lines)[:4096], color=discord.Color.blue())
     await ctx.send(embed=embed)
 
 # music downloader functions
-youtube_dl.utils.bug_reports_message = lambda: ''
-ytdl = youtube_dl.YoutubeDL(ytdl_format_options)
+download_options = {
+    # Keep the native Opus audio so it can be passed through to Discord without transcoding
+    'format': 'bestaudio[acodec=opus]/bestaudio/best',
+    # Name files after the video rather than the title so tracks with the same title don't clash
+    'outtmpl': os.path.join(AUDIO_CACHE_DIR, '%(extractor_key)s-%(id)s.%(ext)s'),
+    'noplaylist': True,
+    'ffmpeg_location': settings['ffmpeg_path'],
+}
+playlist_options = {
+    'extract_flat': 'in_playlist',
+    'playlistend': MAX_PLAYLIST_LENGTH,
+    'quiet': True,
+}
 sp = spotipy.Spotify(auth_manager=SpotifyClientCredentials(client_id=settings['spotify_client_id'], client_secret=settings['spotify_client_secret']))
+spotify = SpotifyResolver(sp, ttl=SPOTIFY_CACHE_TTL)
 
-def get_spotify_track_info(track_url):
-    track_id = track_url.split("/")[-1].split("?")[0]
-    track = sp.track(track_id)
-    return track['name'], track['artists'][0]['name']
-
-def download_from_youtube(query, guild_id, music_queue):
-    ydl_opts = {
-        'format': 'bestaudio/best',
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'mp3',
-            'preferredquality': '192',
-        }],
-        'outtmpl': '%(title)s.%(ext)s',  # Change filename format
-        'ffmpeg_location': settings['ffmpeg_path'],
-    }
-    with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-        try:
-            if "youtube.com" in query or "youtu.be" in query:
-                info_dict = ydl.extract_info(query, download=True)
-            else:
-                info_dict = ydl.extract_info(f"ytsearch:{query}", download=True)
-                if 'entries' in info_dict:
-                    info_dict = info_dict['entries'][0]
-            title = info_dict.get('title', 'Unknown Title')
-            filename = f"{title}.mp3"
-            print(f"Debug: Downloaded music: {title}, Filename: {filename}, Guild ID: {guild_id}")
-            music_queue.put((title, filename, guild_id))
-        except Exception as e:
-            print(f"Error downloading {query}: {e}")
-            music_queue.put((query, None, guild_id))
+def normalize_query(query):
+    """
+    Reduce a ?play argument to a form that is equal for equivalent requests.
+
+    Links to the same video map to its cache key, and search queries ignore
+    case and extra whitespace.
+
+    :param query: A URL or a search query
+    """
+    return key_from_url(query) or ' '.join(query.casefold().split())
+
+def is_youtube_playlist(url):
+    """
+    Check whether a URL points to a YouTube playlist rather than a single video.
+
+    :param url: The URL passed to ?play
+    """
+    parsed = urlparse(url)
+    return ('youtube.com' in (parsed.hostname or '') and parsed.path == '/playlist'
+            and 'list' in parse_qs(parsed.query))
+
+def extract_playlist(url):
+    """
+    List the entries of a YouTube playlist without resolving each video.
+
+    :param url: The URL of the playlist
+    :return: A list of ``(url, title, spotify_id, duration)`` tuples
+    """
+    info_dict = get_ytdl('playlist', playlist_options).extract_info(url, download=False)
+    return [(entry['url'], entry.get('title'), None, entry.get('duration'))
+            for entry in info_dict.get('entries') or [] if entry and entry.get('url')]
+
+async def iterate_youtube_playlist(url):
+    """
+    Flat-extract a YouTube playlist off the event loop and yield its entries.
+
+    :param url: The URL of the playlist
+    """
+    yield await asyncio.get_running_loop().run_in_executor(None, extract_playlist, url)
+
+def handles_guild(guild_id):
+    """
+    Check whether a guild belongs to one of the shards run by this process.
+
+    :param guild_id: The ID of the guild
+    """
+    if not SHARD_COUNT or SHARD_IDS is None:
+        return True
+    return (guild_id >> 22) % SHARD_COUNT in SHARD_IDS
+
+def queued_cache_keys():
+    """
+    Collect the cache keys of every queued track, whose files the audio cache must keep.
+
+    Counting the references from the queues whenever the janitor runs means
+    they can't drift from the queues, whichever way tracks come and go. The
+    last played track of each guild is kept too, so "?skip back" starts
+    right away; older ones are downloaded again if they were evicted.
+    """
+    keys = {track.key for player in players.values() for track in player if track.key is not None}
+    keys.update(player.history[-1].key for player in players.values() if player.history)
+    keys.discard(None)
+    return keys
+
+def get_player(guild_id):
+    """
+    Get the player of a guild, creating it on first use.
+
+    :param guild_id: The ID of the guild
+    """
+    player = players.get(guild_id)
+    if player is None:
+        player = players[guild_id] = GuildPlayer(guild_id, on_change=state_store.mark_dirty)
+    return player
+
+def prefetch(guild_id):
+    """
+    Start resolving the current track and the next ``PREFETCH_DEPTH`` tracks of a guild's queue.
+
+    :param guild_id: The ID of the guild
+    """
+    for track in itertools.islice(get_player(guild_id), PREFETCH_DEPTH + 1):
+        if track.task is None:
+            track.task = bot.loop.create_task(resolve_track(track))
+
+async def resolve_track(track):
+    """
+    Fill in the title and the playable file or stream URL of a queued track.
+
+    :param track: The track to resolve
+    """
+    query = track.query
+    is_search = track.key is None
+    if is_search:
+        # Searches resolved recently go straight to their video
+        query = search_cache.get(normalize_query(query), query)
+        track.key = key_from_url(query)
+        cache_requests.labels('search', 'miss' if track.key is None else 'hit').inc()
+
+    # Serve direct video links straight from the cache without touching yt-dlp
+    cached = audio_cache.get(track.key)
+    if track.key is not None:
+        cache_requests.labels('audio', 'hit' if cached else 'miss').inc()
+    if cached:
+        track.title, track.filename, track.codec = cached['title'], cached['filename'], cached.get('codec')
+        track.gain = cached.get('gain')
+        get_player(track.guild_id).update(track)
+        if cached.get('duration') is not None:
+            get_player(track.guild_id).set_duration(track, cached['duration'])
+        if 'gain' not in cached:
+            # Cached before loudness was measured, so measure it now for the next time it plays
+            analyse_later(track.key, cached['filename'])
+        return
+
+    if PLAYBACK_MODE == 'stream' or track.start_at:
+        # Only resolve the media URL so FFmpeg can start reading it right away, and
+        # a track resumed halfway through fetches just the part it plays
+        with resolve_seconds.labels('stream').time():
+            result = await download_pool.fetch(track.guild_id, (query, track.guild_id, False), key=(normalize_query(query), False))
+        observe_timings(result)
+        track.filename = result['stream_url']
+        if track.filename is not None and STREAM_CACHE_IN_BACKGROUND:
+            bot.loop.create_task(cache_in_background(result['webpage_url']))
+    else:
+        # Hand the download to the worker pool, queued behind this guild's other requests
+        with resolve_seconds.labels('download').time():
+            result = await download_pool.fetch(track.guild_id, (query, track.guild_id, True), key=(normalize_query(query), True))
+        observe_timings(result)
+        track.filename = result['filename']
+        if track.filename is not None:
+            audio_cache.put(result['key'], track.filename, title=result['title'], codec=result['codec'],
+                            duration=result['duration'])
+            # Play right away, the gain applies from the next time the track is opened
+            analyse_later(result['key'], track.filename)
+        track.gain = None
+    track.title, track.key, track.codec = result['title'], result['key'], result['codec']
+    get_player(track.guild_id).update(track)
+    if result['duration'] is not None:
+        get_player(track.guild_id).set_duration(track, result['duration'])
+    if result['key'] is not None and is_search:
+        search_cache.set(normalize_query(track.query), result['webpage_url'])
+    if track.spotify_id and result['key'] is not None:
+        spotify.remember_match(track.spotify_id, result['webpage_url'])
+
+async def cache_in_background(url):
+    """
+    Download a streamed track into the audio cache so later plays don't need the network.
+
+    :param url: The page URL of the video
+    """
+    result = await download_pool.fetch(BACKGROUND_DOWNLOADS, (url, None, True), key=(normalize_query(url), True))
+    observe_timings(result)
+    if result['filename'] is not None:
+        audio_cache.put(result['key'], result['filename'], title=result['title'], codec=result['codec'],
+                        duration=result['duration'])
+        analyse_later(result['key'], result['filename'])
+
+def analyse_later(key, filename):
+    """
+    Measure the loudness of a cached track in the background, unless normalization is off or it's already underway.
+
+    :param key: The cache key of the track
+    :param filename: The cached file
+    """
+    if LOUDNESS_NORMALIZATION and key not in loudness_pending:
+        loudness_pending.add(key)
+        bot.loop.create_task(analyse_in_background(key, filename))
+
+async def analyse_in_background(key, filename):
+    """
+    Measure the loudness of a track cached without it, and store the gain with the cache entry.
+
+    The whole file is decoded, so this runs in a thread rather than holding
+    up the track's first play or a download worker.
+
+    :param key: The cache key of the track
+    :param filename: The cached file
+    """
+    try:
+        started_at = time.perf_counter()
+        loudness = await bot.loop.run_in_executor(None, measure_loudness, settings['ffmpeg_path'], filename)
+        loudness_seconds.observe(time.perf_counter() - started_at)
+        audio_cache.update(key, gain=gain_for(loudness, LOUDNESS_TARGET, LOUDNESS_TRUE_PEAK))
+    finally:
+        loudness_pending.discard(key)
+
+def observe_timings(result):
+    """
+    Record the yt-dlp timings a download worker reported.
+
+    The workers may run in other processes, so they send their timings back
+    with the result instead of recording them directly. Results shared by
+    several waiting tracks are only recorded once.
+
+    :param result: The result returned by ``download_from_youtube``
+    """
+    timings = result.pop('timings', None)
+    if not timings:
+        return
+    if timings.get('search') is not None:
+        search_seconds.labels(timings['search_kind']).observe(timings['search'])
+    if timings.get('download') is not None:
+        download_seconds.observe(timings['download'])
+
+def failed_download(query, timings=None):
+    """
+    The result of a download that didn't work out.
+
+    :param query: The YouTube URL or search query that was requested
+    :param timings: The timings of the calls made before it failed
+    :return: A result dict like the one ``download_from_youtube`` returns, without a file or stream to play
+    """
+    return {'key': None, 'title': query, 'filename': None, 'stream_url': None, 'webpage_url': query, 'codec': None,
+            'duration': None, 'timings': timings or {}}
+
+def lost_download(payload):
+    """
+    Stand in for the result of a download whose worker died or that timed out.
+
+    :param payload: The ``(query, guild_id, download)`` task that was lost
+    """
+    return failed_download(payload[0])
+
+def download_from_youtube(query, guild_id, download=True):
+    """
+    Download a track into the audio cache directory, unless it's already there.
+
+    With ``download`` set to False the track is only resolved, and the direct
+    media URL is returned as ``stream_url`` for FFmpeg to read from.
+
+    :param query: A YouTube URL or a search query
+    :param guild_id: The guild the track was requested in
+    :param download: Whether to download the audio or only resolve it
+    :return: A dict with the cache ``key``, ``title``, ``filename``, ``stream_url``, ``codec`` and ``duration``
+        (None on failure), and the ``timings`` of the yt-dlp calls in seconds
+    """
+    ydl = get_ytdl('download', download_options)
+    timings = {}
+    try:
+        started_at = time.perf_counter()
+        if "youtube.com" in query or "youtu.be" in query:
+            timings['search_kind'] = 'url'
+            info_dict = ydl.extract_info(query, download=False)
+        else:
+            timings['search_kind'] = 'search'
+            info_dict = ydl.extract_info(f"ytsearch:{query}", download=False)
+            if 'entries' in info_dict:
+                info_dict = info_dict['entries'][0]
+        timings['search'] = time.perf_counter() - started_at
+        title = info_dict.get('title', 'Unknown Title')
+        key = make_key(info_dict['extractor_key'], info_dict['id'])
+        result = {'key': key, 'title': title, 'filename': None, 'stream_url': info_dict.get('url'),
+                  'webpage_url': info_dict.get('webpage_url', query), 'codec': info_dict.get('acodec'),
+                  'duration': info_dict.get('duration'), 'timings': timings}
+        if not download:
+            log.debug("Resolved stream %r for guild %s in %.2f s", title, guild_id, timings['search'])
+            return result
+
+        filename = ydl.prepare_filename(info_dict)
+        # Another request may have fetched the same video in the meantime
+        if not os.path.isfile(filename):
+            started_at = time.perf_counter()
+            ydl.process_ie_result(info_dict, download=True)
+            timings['download'] = time.perf_counter() - started_at
+            log.debug("Downloaded %r to %s for guild %s in %.2f s", title, filename, guild_id, timings['download'])
+        return dict(result, filename=filename)
+    except Exception as e:
+        log.error("Error downloading %s: %s", query, e)
+        return failed_download(query, timings)
 
 def music_processor(task_queue, music_queue):
+    # Worker processes started by forkserver or spawn don't inherit the logging setup
+    configure_logging()
     while True:
         item = task_queue.get()
         if item is None:  # Poison pill to shut down the process
+            close_all()
             break
-        print(f"Debug: item: {item}")   
-        query, guild_id = item
-        download_from_youtube(query, guild_id, music_queue)
+        log.debug("Download worker got %r", item)
+        request_id, (query, guild_id, download) = item
+        music_queue.put((request_id, download_from_youtube(query, guild_id, download)))
 
-def shutdown_handler(signal, frame):
+def request_shutdown():
     """
-    Handler to clean up resources when the program is terminated.
+    Start shutting down once SIGINT or SIGTERM arrives. Runs on the event loop.
     """
-    for voice_client in bot.voice_clients:
-        asyncio.run_coroutine_threadsafe(voice_client.disconnect(), bot.loop)
-    bot.loop.stop()
+    global shutdown_task
+    if shutdown_task is None:
+        log.info("Shutting down")
+        shutdown_task = bot.loop.create_task(shutdown())
 
-def main():
-    global task_queue, music_queue
-    task_queue = multiprocessing.Queue()
-    music_queue = multiprocessing.Queue()
+async def shutdown():
+    """
+    Save the queues, leave the voice channels and stop the bot.
 
-    # Start the music processor
-    process = multiprocessing.Process(target=music_processor, args=(task_queue, music_queue), daemon=True)
-    process.start()
+    This runs as a task on the event loop rather than in the signal handler,
+    so the voice disconnects actually get to run before the loop stops.
+    """
+    # Save the queues while the voice connections to restore are still known, along with how far every song got
+    for guild_id, player in players.items():
+        if player.current is not None:
+            state_store.mark_dirty(guild_id)
+    state_store.flush(snapshot_guild)
+    audio_cache.flush()
+    await asyncio.gather(*(voice_client.disconnect(force=True) for voice_client in bot.voice_clients),
+                         return_exceptions=True)
+    download_pool.close()
+    loop_watchdog.stop()
+    await bot.close()
 
-    # Example: Add tasks to the task queue
-    # music_url = 'http://example.com/music.mp3'
-    # task_queue.put((music_url, None))
+def main():
+    global audio_cache, download_pool, state_store
+    configure_logging()
+    audio_cache = AudioCache(AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_BYTES)
+    state_store = StateStore(STATE_DB_PATH, interval=STATE_FLUSH_INTERVAL)
+    # Workers are forked from a clean forkserver process rather than from the bot, whose threads may hold locks
+    start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    mp_context = multiprocessing.get_context(start_method)
+    download_pool = DownloadPool(
+        music_processor,
+        min_workers=MIN_DOWNLOAD_WORKERS,
+        max_workers=MAX_DOWNLOAD_WORKERS,
+        mode=DOWNLOAD_WORKER_MODE,
+        idle_timeout=DOWNLOAD_WORKER_IDLE_TIMEOUT,
+        timeout=DOWNLOAD_TIMEOUT,
+        on_lost=lost_download,
+        context=mp_context,
+    )
 
-    # title, filename, guild_id = music_queue.get()
-    # print(f"Downloaded music: {title}, Filename: {filename}")
+    # Start the music download workers, and the forkserver with them, while this process has no other threads
+    download_pool.start()
 
 if __name__ == '__main__':
-    signal.signal(signal.SIGINT, shutdown_handler)
-    signal.signal(signal.SIGTERM, shutdown_handler)
     main()
     # Run the bot using the token from the settings file
-    bot.run(settings['token'])
+    # Logging is already set up by configure_logging
+    bot.run(settings['token'], log_handler=None)
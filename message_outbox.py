@@ -0,0 +1,169 @@
+# Standard library imports
+import asyncio
+import itertools
+import logging
+import time
+from collections import deque
+
+# Third-party imports
+import discord
+
+log = logging.getLogger(__name__)
+
+# Message priorities, the lowest is sent first
+PRIORITY_PLAYBACK = 0  # e.g. "Now playing"
+PRIORITY_RESPONSE = 1  # direct answers to commands and buttons
+PRIORITY_INFO = 2  # e.g. "Added to queue", held back for a moment so bursts can be merged
+
+# The most lines merged into one message, further lines start a new message
+MAX_MERGED_LINES = 10
+
+
+class _Message:
+    __slots__ = ('embed', 'lines', 'priority', 'order', 'key', 'merge', 'edit', 'view', 'on_sent', 'queued_at')
+
+    def __init__(self, embed, priority, order, key, merge, edit, view, on_sent):
+        self.embed = embed
+        self.lines = [embed.description] if embed.description else []
+        self.priority = priority
+        self.order = order
+        self.key = key
+        self.merge = merge
+        self.edit = edit
+        self.view = view
+        self.on_sent = on_sent
+        self.queued_at = time.monotonic()
+
+    def render(self):
+        if not self.merge:
+            return self.embed
+        embed = self.embed.copy()
+        embed.description = '\n'.join(self.lines)
+        return embed
+
+
+class _Channel:
+    __slots__ = ('channel', 'waiting', 'keyed', 'sent', 'send_times', 'wakeup', 'task')
+
+    def __init__(self, channel, rate):
+        self.channel = channel
+        self.waiting = []  # messages not sent yet
+        self.keyed = {}  # key -> the waiting message with that key
+        self.sent = {}  # key -> (message, lines) of the last message sent with that key
+        self.send_times = deque(maxlen=rate)
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+
+class MessageOutbox:
+    """
+    Sends the bot's messages to each channel in priority order, within Discord's rate limits.
+
+    Every channel has its own queue that is sent from by one task at most
+    ``rate`` messages every ``per`` seconds, so a busy channel never runs
+    into 429 responses and the messages that matter most go out first.
+    Messages given a key replace the waiting message with the same key, or
+    are merged into it, so bursts end up as a single message. They can also
+    update the last message sent with their key instead of sending a new one.
+    """
+
+    def __init__(self, *, rate=5, per=5.0, coalesce_delay=0.5):
+        """
+        :param rate: The number of messages sent or edited per channel within ``per`` seconds
+        :param per: The length of the rate limit window in seconds
+        :param coalesce_delay: The number of seconds ``PRIORITY_INFO`` messages wait for others to merge with
+        """
+        self.rate = rate
+        self.per = per
+        self.coalesce_delay = coalesce_delay
+        self._channels = {}
+        self._order = itertools.count()
+
+    def post(self, channel, embed, *, priority=PRIORITY_RESPONSE, key=None, merge=False, edit=False, view=None,
+             on_sent=None):
+        """
+        Queue an embed to be sent to a channel.
+
+        :param channel: The channel to send to
+        :param embed: The embed to send
+        :param priority: One of the ``PRIORITY_*`` values
+        :param key: Identifies messages that supersede each other, e.g. "now_playing"
+        :param merge: Add the description of the embed as a line to the waiting message with the same key,
+            or to the last one sent if it is still the latest message in the channel,
+            unless that message already has ``MAX_MERGED_LINES`` lines
+        :param edit: Edit the last message sent with the same key instead of sending a new one
+        :param view: The view to attach to the message
+        :param on_sent: A function called with the message once it has been sent or edited,
+            unless it was merged into or replaced by another message with the same key first
+        """
+        state = self._channels.get(channel.id)
+        if state is None:
+            state = self._channels[channel.id] = _Channel(channel, self.rate)
+        state.channel = channel
+
+        message = _Message(embed, priority, next(self._order), key, merge, edit, view, on_sent)
+        if key is not None:
+            waiting = state.keyed.get(key)
+            if waiting is not None:
+                if merge and len(waiting.lines) + len(message.lines) <= MAX_MERGED_LINES:
+                    waiting.lines.extend(message.lines)
+                    return
+                if not merge:
+                    state.waiting.remove(waiting)
+                # A full message still goes out as it is, and later lines merge into this one
+            state.keyed[key] = message
+        state.waiting.append(message)
+
+        state.wakeup.set()
+        if state.task is None or state.task.done():
+            state.task = asyncio.get_running_loop().create_task(self._drain(state))
+
+    async def _drain(self, state):
+        while state.waiting:
+            state.wakeup.clear()
+            message = min(state.waiting, key=lambda waiting: (waiting.priority, waiting.order))
+
+            delay = 0
+            if message.priority >= PRIORITY_INFO:
+                delay = message.queued_at + self.coalesce_delay - time.monotonic()
+            if len(state.send_times) == self.rate:
+                delay = max(delay, state.send_times[0] + self.per - time.monotonic())
+            if delay > 0:
+                # Wake up early when something more urgent comes in
+                try:
+                    await asyncio.wait_for(state.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                # Pick again, the most urgent message may have changed
+                continue
+
+            state.waiting.remove(message)
+            if state.keyed.get(message.key) is message:
+                del state.keyed[message.key]
+            try:
+                await self._deliver(state, message)
+            except discord.HTTPException as e:
+                log.error("Error sending message to channel %s: %s", state.channel.id, e)
+
+    async def _deliver(self, state, message):
+        channel = state.channel
+        previous = state.sent.get(message.key) if message.key is not None else None
+        sent = None
+        if previous is not None:
+            previous_message, previous_lines = previous
+            if message.edit or (message.merge and channel.last_message_id == previous_message.id
+                                and len(previous_lines) + len(message.lines) <= MAX_MERGED_LINES):
+                if message.merge:
+                    message.lines = previous_lines + message.lines
+                try:
+                    sent = await previous_message.edit(embed=message.render(), view=message.view)
+                except discord.NotFound:
+                    sent = None
+        if sent is None:
+            sent = await channel.send(embed=message.render(), view=message.view)
+        state.send_times.append(time.monotonic())
+
+        if message.key is not None:
+            state.sent[message.key] = (sent, message.lines)
+        if message.on_sent is not None:
+            message.on_sent(sent)
@@ -0,0 +1,157 @@
+"""
+Run the bot as several processes, each with its own share of the shards.
+
+    python shard_supervisor.py
+
+Every process runs ``main.py`` as an ``AutoShardedBot`` for its shards, with
+its own event loop, download workers, FFmpeg processes and guild state, so
+busy guilds only slow down the guilds on the same process and voice work is
+spread over the CPU cores. The supervisor starts the processes a few
+seconds apart to stay within Discord's identify rate limit, restarts any
+that exit with a growing delay, and stops them all on SIGINT or SIGTERM.
+
+``SHARD_COUNT`` sets the number of shards, or Discord's recommendation is
+used if it is null. ``SHARD_PROCESSES`` sets the number of processes,
+which defaults to the number of CPU cores.
+"""
+# Standard library imports
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+from pathlib import Path
+
+log = logging.getLogger('shard_supervisor')
+
+ROOT = Path(__file__).resolve().parent
+
+# How long a process has to run before its restart delay starts over
+STABLE_AFTER = 60
+MAX_RESTART_DELAY = 60
+STOP_TIMEOUT = 30
+
+
+def fetch_gateway_info(token):
+    """
+    Ask Discord how many shards the bot should use and how many of them may identify at once.
+
+    :param token: The bot token
+    :return: A ``(shard_count, max_concurrency)`` tuple
+    """
+    request = urllib.request.Request('https://discord.com/api/v10/gateway/bot',
+                                     headers={'Authorization': f'Bot {token}', 'User-Agent': 'DiscordBot'})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        info = json.load(response)
+    return info['shards'], info.get('session_start_limit', {}).get('max_concurrency', 1)
+
+
+class ShardProcess:
+    """
+    One bot process and the shards it runs.
+    """
+
+    def __init__(self, index, process_count, shard_ids, shard_count):
+        self.index = index
+        self.process_count = process_count
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.process = None
+        self.started_at = None
+        self.restarts = 0
+        # When to start the process again after it exited, if it should be
+        self.restart_at = None
+
+    def start(self):
+        env = dict(os.environ,
+                   MUSICBOT_SHARD_COUNT=str(self.shard_count),
+                   MUSICBOT_SHARD_IDS=','.join(map(str, self.shard_ids)),
+                   MUSICBOT_PROCESS_INDEX=str(self.index),
+                   MUSICBOT_PROCESS_COUNT=str(self.process_count))
+        # A session of its own keeps Ctrl+C in the terminal from reaching the bot before the supervisor
+        self.process = subprocess.Popen([sys.executable, str(ROOT / 'main.py')], cwd=ROOT, env=env,
+                                        start_new_session=True)
+        self.started_at = time.monotonic()
+        self.restart_at = None
+        log.info("Started process %d (pid %d) for shards %s", self.index, self.process.pid, self.shard_ids)
+
+    def check(self):
+        """
+        Notice if the process has exited, and start it again once its restart delay is over.
+        """
+        if self.restart_at is not None:
+            if time.monotonic() >= self.restart_at:
+                self.start()
+            return
+        code = self.process.poll()
+        if code is None:
+            return
+        if time.monotonic() - self.started_at >= STABLE_AFTER:
+            self.restarts = 0
+        delay = min(MAX_RESTART_DELAY, 2 ** self.restarts)
+        self.restarts += 1
+        self.restart_at = time.monotonic() + delay
+        log.error("Process %d for shards %s exited with code %s, restarting in %d s", self.index, self.shard_ids, code, delay)
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    os.chdir(ROOT)
+    with open('settings.json', 'r') as f:
+        settings = json.load(f)
+
+    shard_count = settings.get('SHARD_COUNT')
+    max_concurrency = 1
+    if not shard_count:
+        shard_count, max_concurrency = fetch_gateway_info(settings['token'])
+        log.info("Discord recommends %d shards", shard_count)
+    process_count = max(1, min(settings.get('SHARD_PROCESSES') or os.cpu_count() or 1, shard_count))
+    start_delay = settings.get('SHARD_START_DELAY', 5)
+
+    processes = [ShardProcess(index, process_count, list(range(index, shard_count, process_count)), shard_count)
+                 for index in range(process_count)]
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    for shard_process in processes:
+        if stopping:
+            break
+        shard_process.start()
+        # Each process identifies its shards one batch of max_concurrency at a time, five seconds apart
+        time.sleep(start_delay * -(-len(shard_process.shard_ids) // max_concurrency))
+
+    while not stopping:
+        for shard_process in processes:
+            shard_process.check()
+        time.sleep(1)
+
+    log.info("Stopping %d processes", process_count)
+    for shard_process in processes:
+        shard_process.stop()
+    deadline = time.monotonic() + STOP_TIMEOUT
+    for shard_process in processes:
+        if shard_process.process is None:
+            continue
+        try:
+            shard_process.process.wait(max(0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            log.warning("Process %d didn't stop in time, killing it", shard_process.index)
+            shard_process.process.kill()
+
+
+if __name__ == '__main__':
+    main()
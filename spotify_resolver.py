@@ -0,0 +1,162 @@
+# Standard library imports
+import asyncio
+import functools
+from urllib.parse import urlparse
+
+# Local Files
+from ttl_cache import TTLCache
+
+# The most track IDs the Spotify multi-track endpoint accepts per call
+TRACKS_PER_REQUEST = 50
+
+
+def parse_spotify_url(url):
+    """
+    Split a Spotify link into its kind and ID.
+
+    :param url: A link such as https://open.spotify.com/playlist/<id>
+    :return: A ``(kind, id)`` tuple, e.g. ``("track", "<id>")``
+    """
+    parts = [part for part in urlparse(url).path.split('/') if part and not part.startswith('intl-')]
+    if len(parts) < 2:
+        return None, None
+    return parts[-2], parts[-1]
+
+
+def search_query(track):
+    """
+    Build the YouTube search query for a Spotify track object.
+
+    :param track: A track object returned by the Spotify Web API
+    """
+    return f"{track['name']} {track['artists'][0]['name']}"
+
+
+class SpotifyResolver:
+    """
+    Turns Spotify tracks into YouTube search queries without blocking the event loop.
+
+    Track lookups made within ``batch_delay`` seconds of each other are
+    merged into one call to the multi-track endpoint. Both the Spotify
+    metadata and the YouTube video a track was matched to are cached for
+    ``ttl`` seconds, so repeat requests skip the Spotify API and ``ytsearch``.
+    """
+
+    def __init__(self, sp, *, ttl=86400, maxsize=10000, batch_delay=0.05):
+        """
+        :param sp: The spotipy client
+        :param ttl: The number of seconds lookups and matches are cached for
+        :param maxsize: The maximum number of tracks kept in each cache
+        :param batch_delay: The number of seconds lookups are held back to form a batch
+        """
+        self._sp = sp
+        self.batch_delay = batch_delay
+        self._queries = TTLCache(ttl, maxsize)  # track ID -> search query
+        self._matches = TTLCache(ttl, maxsize)  # track ID -> YouTube URL
+        self._lookups = {}  # track ID -> future, for lookups not answered yet
+        self._waiting = []  # track IDs not sent to Spotify yet
+        self._flush_handle = None
+
+    async def get_query(self, track_id):
+        """
+        Get the YouTube search query of a Spotify track.
+
+        :param track_id: The Spotify ID of the track
+        """
+        query = self._queries.get(track_id)
+        if query is not None:
+            return query
+
+        loop = asyncio.get_running_loop()
+        future = self._lookups.get(track_id)
+        if future is None:
+            future = loop.create_future()
+            self._lookups[track_id] = future
+            self._waiting.append(track_id)
+            if len(self._waiting) >= TRACKS_PER_REQUEST:
+                self._flush()
+            elif self._flush_handle is None:
+                self._flush_handle = loop.call_later(self.batch_delay, self._flush)
+        # Several commands may wait on the same lookup, don't let one cancel it for the others
+        return await asyncio.shield(future)
+
+    def get_match(self, track_id):
+        """
+        Get the YouTube URL a Spotify track was last matched to.
+
+        :param track_id: The Spotify ID of the track
+        :return: The URL, or None if the track hasn't been matched yet
+        """
+        return self._matches.get(track_id)
+
+    def remember_match(self, track_id, url):
+        """
+        Record the YouTube video a Spotify track was matched to.
+
+        :param track_id: The Spotify ID of the track
+        :param url: The page URL of the YouTube video
+        """
+        self._matches.set(track_id, url)
+
+    async def iterate_collection(self, kind, collection_id):
+        """
+        Fetch the tracks of a playlist or album page by page, off the event loop.
+
+        Tracks that were matched before are yielded with their YouTube URL as
+        the query. Durations are in seconds.
+
+        :param kind: "playlist" or "album"
+        :param collection_id: The Spotify ID of the playlist or album
+        :return: An async iterator of lists of ``(query, title, track_id, duration)`` entries
+        """
+        loop = asyncio.get_running_loop()
+        if kind == 'album':
+            fetch_first = functools.partial(self._sp.album_tracks, collection_id, limit=50)
+        else:
+            fetch_first = functools.partial(self._sp.playlist_items, collection_id, additional_types=('track',))
+        page = await loop.run_in_executor(None, fetch_first)
+
+        while page:
+            entries = []
+            for item in page['items']:
+                # Playlist items wrap the track, album items are the track
+                track = item.get('track') if kind == 'playlist' else item
+                if not (track and track.get('name') and track.get('artists')):
+                    continue
+                title = search_query(track)
+                if track.get('id'):
+                    self._queries.set(track['id'], title)
+                duration = track['duration_ms'] / 1000 if track.get('duration_ms') else None
+                entries.append((self.get_match(track.get('id')) or title, title, track.get('id'), duration))
+            yield entries
+            page = await loop.run_in_executor(None, self._sp.next, page) if page['next'] else None
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        batch, self._waiting = self._waiting, []
+        for start in range(0, len(batch), TRACKS_PER_REQUEST):
+            asyncio.get_running_loop().create_task(self._fetch(batch[start:start + TRACKS_PER_REQUEST]))
+
+    async def _fetch(self, track_ids):
+        try:
+            response = await asyncio.get_running_loop().run_in_executor(None, self._sp.tracks, track_ids)
+        except Exception as e:
+            for track_id in track_ids:
+                future = self._lookups.pop(track_id)
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for track_id, track in zip(track_ids, response['tracks']):
+            future = self._lookups.pop(track_id)
+            if future.done():
+                continue
+            if track is None:
+                future.set_exception(ValueError(f"Unknown Spotify track: {track_id}"))
+                continue
+            query = search_query(track)
+            self._queries.set(track_id, query)
+            future.set_result(query)
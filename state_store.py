@@ -0,0 +1,205 @@
+# Standard library imports
+import asyncio
+import logging
+import sqlite3
+import threading
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS guilds (
+    guild_id INTEGER PRIMARY KEY,
+    voice_channel_id INTEGER,
+    text_channel_id INTEGER,
+    repeat_queue INTEGER NOT NULL,
+    repeat_song INTEGER NOT NULL,
+    current_offset REAL
+);
+CREATE TABLE IF NOT EXISTS tracks (
+    guild_id INTEGER NOT NULL,
+    track_id INTEGER NOT NULL,
+    place TEXT NOT NULL,
+    position REAL NOT NULL,
+    query TEXT NOT NULL,
+    title TEXT,
+    spotify_id TEXT,
+    key TEXT,
+    duration REAL,
+    PRIMARY KEY (guild_id, track_id)
+);
+"""
+
+
+def _track_row(track):
+    return track.track_id, track.place, track.order, track.query, track.title, track.spotify_id, track.key, track.duration
+
+
+class StateStore:
+    """
+    Keeps a copy of every guild's queue in SQLite so it survives restarts and crashes.
+
+    Players only mark their guild and the tracks that changed, which is
+    cheap enough to do on every queue operation. Every ``interval`` seconds
+    the rows of the changed guilds and tracks are collected on the event
+    loop and written in a single transaction from a worker thread, so a
+    burst of changes costs one write, and a track added to or resolved in a
+    long queue only writes that track. A guild's tracks are only all
+    written again when they were replaced or cleared, or the first time the
+    guild changes after a start. The database is in WAL mode, so a crash
+    loses at most the last ``interval`` seconds of changes.
+    """
+
+    def __init__(self, path, *, interval=1.0):
+        """
+        :param path: The path of the SQLite database file
+        :param interval: The number of seconds between writes
+        """
+        self.interval = interval
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._dirty = set()
+        self._tracks = {}  # guild_id -> {track_id: track} of the tracks to write
+        self._replace = set()  # guilds to write every track of
+        # Guilds whose tracks in the database are known to match this process's, so changes can be written one by one
+        self._synced = set()
+        self._closed = False
+
+    def mark_dirty(self, guild_id, tracks=(), replace=False):
+        """
+        Note that the state of a guild has changed and has to be written.
+
+        :param guild_id: The ID of the guild
+        :param tracks: The tracks whose place, order or details changed, including ones that left the queue;
+            they need a ``track_id``, ``place`` (None once gone) and ``order`` besides the saved fields
+        :param replace: Whether every track of the guild may have changed
+        """
+        self._dirty.add(guild_id)
+        if replace or guild_id not in self._synced:
+            self._replace.add(guild_id)
+        elif tracks:
+            self._tracks.setdefault(guild_id, {}).update((track.track_id, track) for track in tracks)
+
+    def load(self):
+        """
+        Read back every saved guild.
+
+        :return: A dict of guild ID -> dict with the ``voice_channel_id``, ``text_channel_id``,
+            ``repeat_queue``, ``repeat_song`` and ``current_offset`` (the playback position of the
+            current track in seconds, or None) of the guild, and its tracks under ``current``
+            (a row or None), ``upcoming`` and ``history`` (lists of rows, in order). Track rows are
+            dicts with ``query``, ``title``, ``spotify_id``, ``key`` and ``duration``.
+        """
+        with self._lock:
+            guilds = {}
+            for guild_id, voice_channel_id, text_channel_id, repeat_queue, repeat_song, current_offset in self._db.execute(
+                    'SELECT guild_id, voice_channel_id, text_channel_id, repeat_queue, repeat_song, current_offset FROM guilds'):
+                guilds[guild_id] = {'voice_channel_id': voice_channel_id, 'text_channel_id': text_channel_id,
+                                    'repeat_queue': bool(repeat_queue), 'repeat_song': bool(repeat_song),
+                                    'current_offset': current_offset, 'current': None, 'upcoming': [], 'history': []}
+
+            for guild_id, place, query, title, spotify_id, key, duration in self._db.execute(
+                    'SELECT guild_id, place, query, title, spotify_id, key, duration FROM tracks '
+                    'ORDER BY guild_id, place, position'):
+                if guild_id not in guilds:
+                    continue
+                row = {'query': query, 'title': title, 'spotify_id': spotify_id, 'key': key, 'duration': duration}
+                if place == 'current':
+                    guilds[guild_id]['current'] = row
+                else:
+                    guilds[guild_id][place].append(row)
+            return guilds
+
+    async def run(self, snapshot):
+        """
+        Write the changed guilds every ``interval`` seconds until cancelled.
+
+        :param snapshot: A function taking a guild ID and returning its ``(guild_row, tracks)``, where ``tracks``
+            iterates over every saved track and is only used when all of them are written,
+            or None when nothing is left to save for the guild
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            if self._dirty:
+                changes = self._take(snapshot)
+                try:
+                    await loop.run_in_executor(None, self._write, changes)
+                except sqlite3.Error as e:
+                    log.error("Error saving queue state: %s", e)
+                    # Nothing of it was written, so write these guilds in full next time
+                    for guild_id, _, _, _ in changes:
+                        self.mark_dirty(guild_id, replace=True)
+
+    async def save_offsets(self, offsets):
+        """
+        Save how far the current tracks have played, without writing anything else.
+
+        :param offsets: ``(guild_id, current_offset)`` pairs
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self._write_offsets, offsets)
+        except sqlite3.Error as e:
+            log.error("Error saving playback positions: %s", e)
+
+    def flush(self, snapshot):
+        """
+        Write the changed guilds right away and stop accepting writes, e.g. on shutdown.
+
+        Must be called from the event loop thread.
+
+        :param snapshot: See ``run``
+        """
+        self._write(self._take(snapshot))
+        with self._lock:
+            self._closed = True
+            self._db.close()
+
+    def _take(self, snapshot):
+        dirty, self._dirty = self._dirty, set()
+        tracks, self._tracks = self._tracks, {}
+        replace, self._replace = self._replace, set()
+        changes = []
+        for guild_id in dirty:
+            state = snapshot(guild_id)
+            if state is None:
+                # Deleting the guild deletes all of its tracks
+                changes.append((guild_id, None, (), True))
+                self._synced.add(guild_id)
+                continue
+            guild_row, all_tracks = state
+            if guild_id in replace:
+                changes.append((guild_id, guild_row, [_track_row(track) for track in all_tracks], True))
+                self._synced.add(guild_id)
+            else:
+                changes.append((guild_id, guild_row, [_track_row(track) for track in tracks.get(guild_id, {}).values()],
+                                False))
+        return changes
+
+    def _write_offsets(self, offsets):
+        with self._lock:
+            if self._closed:
+                return
+            with self._db:
+                self._db.executemany('UPDATE guilds SET current_offset = ? WHERE guild_id = ?',
+                                     [(offset, guild_id) for guild_id, offset in offsets])
+
+    def _write(self, changes):
+        with self._lock:
+            if self._closed:
+                return
+            with self._db:
+                for guild_id, guild_row, track_rows, replace in changes:
+                    if replace:
+                        self._db.execute('DELETE FROM tracks WHERE guild_id = ?', (guild_id,))
+                    if guild_row is None:
+                        self._db.execute('DELETE FROM guilds WHERE guild_id = ?', (guild_id,))
+                        continue
+                    self._db.execute('INSERT OR REPLACE INTO guilds VALUES (?, ?, ?, ?, ?, ?)', (guild_id,) + guild_row)
+                    self._db.executemany('DELETE FROM tracks WHERE guild_id = ? AND track_id = ?',
+                                         [(guild_id, row[0]) for row in track_rows if row[1] is None])
+                    self._db.executemany('INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                         [(guild_id,) + row for row in track_rows if row[1] is not None])
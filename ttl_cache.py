@@ -0,0 +1,51 @@
+# Standard library imports
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    A small in-memory mapping whose entries expire after ``ttl`` seconds.
+
+    Once ``maxsize`` entries are stored, the oldest ones are dropped first.
+    """
+
+    def __init__(self, ttl, maxsize=10000):
+        """
+        :param ttl: The number of seconds an entry stays valid
+        :param maxsize: The maximum number of entries kept
+        """
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """
+        Look up a key, treating expired entries as missing.
+
+        :param key: The key to look up
+        :param default: The value returned on a miss
+        """
+        item = self._entries.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return default
+        return value
+
+    def set(self, key, value):
+        """
+        Store a value, replacing any previous one.
+
+        :param key: The key to store the value under
+        :param value: The value to store
+        """
+        self._entries.pop(key, None)
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
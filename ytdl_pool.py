@@ -0,0 +1,42 @@
+# Standard library imports
+import threading
+
+# Third-party imports
+import yt_dlp as youtube_dl
+
+youtube_dl.utils.bug_reports_message = lambda *args, **kwargs: ''
+
+# Every thread (and so every download worker, thread or process) keeps its own instances
+_local = threading.local()
+
+
+def get_ytdl(name, options):
+    """
+    Get the long-lived YoutubeDL instance of the calling thread for an option set.
+
+    Building a YoutubeDL initializes its extractors and HTTP handlers, so the
+    instance is created on first use and then reused for every later request
+    made from the same thread, along with its open HTTP connections. Instances
+    are never shared between threads, as YoutubeDL isn't thread-safe.
+
+    :param name: The name of the option set, e.g. "download"
+    :param options: The options used to create the instance on first use
+    :return: The YoutubeDL instance
+    """
+    instances = getattr(_local, 'instances', None)
+    if instances is None:
+        instances = _local.instances = {}
+
+    ydl = instances.get(name)
+    if ydl is None:
+        ydl = instances[name] = youtube_dl.YoutubeDL(options)
+    return ydl
+
+
+def close_all():
+    """
+    Close the instances of the calling thread, e.g. before a worker exits.
+    """
+    for ydl in getattr(_local, 'instances', {}).values():
+        ydl.close()
+    _local.instances = {}
@@ -1,17 +1,20 @@
 import asyncio
+import logging
 import os
-import traceback
 import discord
-import yt_dlp as youtube_dl
 import json
 
+from ytdl_pool import get_ytdl
+
+log = logging.getLogger(__name__)
+
 # Load settings from a JSON file
 with open('settings.json', 'r') as f:
     settings = json.load(f)
 
 # Configuration for youtube_dl
 ytdl_format_options = {
-    'format': 'bestaudio/best',
+    'format': 'bestaudio[acodec=opus]/bestaudio/best',
     'outtmpl': '%(extractor)s-%(id)s-%(title)s.%(ext)s',
     'restrictfilenames': True,
     'noplaylist': True,
@@ -23,22 +26,19 @@ ytdl_format_options = {
     'default_search': 'auto',
     'source_address': '0.0.0.0',  # Bind to ipv4 since ipv6 addresses cause issues sometimes
     'force-ipv4': True,
-    'preferredcodec': 'mp3',
-    'postprocessors': [{
-        'key': 'FFmpegExtractAudio',
-        'preferredcodec': 'mp3',
-        'preferredquality': '192',
-    }],
     'ffmpeg_location': settings['ffmpeg_path'],  # Added FFmpeg location
 }
 
-# FFmpeg options for audio processing
+# FFmpeg options for playing a local file; the reconnect flags only apply to HTTP inputs
 ffmpeg_options = {
-    'options': '-vn -reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
+    'options': '-vn'
 }
 
-# Create a youtube_dl object with the specified options
-ytdl = youtube_dl.YoutubeDL(ytdl_format_options)
+# FFmpeg options for reading straight from a remote media URL
+ffmpeg_stream_options = {
+    'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
+    'options': '-vn'
+}
 
 class YTDLSource(discord.PCMVolumeTransformer):
     def __init__(self, source, *, data, volume=0.5):
@@ -51,36 +51,37 @@ class YTDLSource(discord.PCMVolumeTransformer):
     @classmethod
     async def from_url(cls, url, *, loop=None, stream=False):
         loop = loop or asyncio.get_event_loop()
-        ytdl_opts = ytdl_format_options.copy()
-        ytdl_opts['ffmpeg_location'] = settings['ffmpeg_path']
-        ytdl = youtube_dl.YoutubeDL(ytdl_opts)
+
+        def extract():
+            # Runs in the executor thread, so it uses that thread's own YoutubeDL instance
+            ytdl = get_ytdl('source', ytdl_format_options)
+            data = ytdl.extract_info(url, download=not stream)
+            if data is not None and 'entries' in data:
+                data = data['entries'][0]
+            if data is not None and not stream:
+                data['filename'] = ytdl.prepare_filename(data)
+            return data
         
         try:
-            data = await loop.run_in_executor(None, lambda: ytdl.extract_info(url, download=not stream))
+            data = await loop.run_in_executor(None, extract)
             
             if data is None:
-                print(f"Error: Unable to extract info for {url}")
+                log.error("Unable to extract info for %s", url)
                 return None
 
-            if 'entries' in data:
-                data = data['entries'][0]
+            filename = data['url'] if stream else data['filename']
 
             if stream:
-                filename = data['url']
-            else:
-                filename = ytdl.prepare_filename(data)
-                filename = os.path.splitext(filename)[0] + ".mp3"
-                data['filename'] = filename
+                return cls(discord.FFmpegPCMAudio(filename, executable=settings['ffmpeg_path'], **ffmpeg_stream_options), data=data)
 
             absolute_filename = os.path.abspath(filename)
-            print(f"Debug: Filename for {url} is {absolute_filename}") 
+            log.debug("Filename for %s is %s", url, absolute_filename)
 
             if not os.path.isfile(absolute_filename):
-                print(f"Error: File {absolute_filename} does not exist.")
+                log.error("File %s does not exist", absolute_filename)
                 return None
 
             return cls(discord.FFmpegPCMAudio(absolute_filename, executable=settings['ffmpeg_path'], **ffmpeg_options), data=data)
         except Exception as e:
-            print(f"Error in from_url: {e}")
-            traceback.print_exc()
+            log.exception("Error in from_url: %s", e)
             return None
\ No newline at end of file